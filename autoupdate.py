@@ -1,4 +1,5 @@
 import os
+import re
 import requests
 import shutil
 import subprocess
@@ -6,47 +7,152 @@ import sys
 import tempfile
 import traceback
 
+from py_modules.http_cache import HttpCache
+from py_modules.metrics import metrics
+from py_modules.msdelta import MSDelta
 from py_modules.msync import MSync
 
-def get_latest_release(api_url):
-    response = requests.get(api_url)
-    response.raise_for_status()
-    return response.json()
+def get_latest_release(api_url, cache):
+    return cache.get_json(api_url, {"Accept": "application/vnd.github.v3+json"})
     
-def get_latest_msync_url(release):
+def get_latest_version(release, name, cache):
+    # Multi-app releases publish a latest-linux.yml per app, its version may differ from the release tag
+    file_name = re.sub(r"[^a-zA-Z0-9]", "-", name).lower()
     for asset in release["assets"]:
-        if str(asset["name"]).lower().endswith(".msync"):
-            return asset["browser_download_url"]
+        if str(asset["name"]).lower() == f"{file_name}-latest-linux.yml":
+            match = re.search(r"^version:\s*['\"]?([^'\"\n]+)", cache.get(asset["browser_download_url"]).decode(), re.MULTILINE)
+            if match:
+                return match.group(1).strip()
+    return release["tag_name"]
+
+def get_staged_path(appimage):
+    # Must match the path AppRun swaps in on the next launch
+    return os.path.join(os.path.dirname(appimage), f".{os.path.basename(appimage)}.staged")
+
+def touch_update_stamp():
+    # AppRun skips the next checks for a while after this one succeeded
+    stamp = os.getenv("APPIMAGE_UPDATE_STAMP")
+    if stamp:
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with open(stamp, "a"):
+            os.utime(stamp)
+
+def write_metrics(**extra):
+    # Opt-in: APPIMAGE_UPDATE_METRICS is a file where a JSON line is appended per check
+    metrics_path = os.getenv("APPIMAGE_UPDATE_METRICS")
+    if metrics_path:
+        try:
+            metrics.append_json(metrics_path, **extra)
+        except OSError as e:
+            print(f"Couldn't write update metrics: {e}")
+
+def get_latest_msync_url(release, name):
+    # Prefer the binary manifest, releases made before it only have the JSON one.
+    # Releases with several apps (multi-app builds) are matched by the AppImage file name
+    file_name = re.sub(r"[^a-zA-Z0-9]", "-", name).lower()
+    for suffix in [".msync.bin", ".msync"]:
+        assets = [asset for asset in release["assets"] if str(asset["name"]).lower().endswith(suffix)]
+        for asset in assets:
+            if str(asset["name"]).lower() == f"{file_name}.appimage{suffix}":
+                return asset["browser_download_url"]
+        if assets:
+            return assets[0]["browser_download_url"]
     raise FileNotFoundError("MSync file not found")
 
+def get_delta_url(release, name, version):
+    # Only published for the version right before the release. As with the manifest, the name
+    # is matched first, Electron builds name the file after the package instead of the app
+    delta_name = MSDelta.get_asset_name(name, version).lower()
+    suffix = delta_name[delta_name.index(".appimage."):]
+    assets = [asset for asset in release["assets"] if str(asset["name"]).lower().endswith(suffix)]
+    for asset in assets:
+        if str(asset["name"]).lower() == delta_name:
+            return asset["browser_download_url"]
+    return assets[0]["browser_download_url"] if len(assets) == 1 else None
+
+def apply_delta(release, name, version, msync, appimage, output_path):
+    # Returns False when there is no usable delta, MSync patches the file then
+    delta_url = get_delta_url(release, name, version)
+    if delta_url is None:
+        return False
+    try:
+        print(f"Applying delta from version {version}")
+        with metrics.phase("msdelta.download"):
+            response = requests.get(delta_url)
+            response.raise_for_status()
+        delta = MSDelta.from_bytes(response.content)
+        # The result must be exactly what the manifest describes
+        if delta.target_hash != msync.hash or delta.file_hash != msync.file_hash:
+            raise Exception("Delta doesn't match the MSync manifest")
+        delta.apply(appimage, output_path)
+        print(f"Delta applied ({MSync.format_bytes(len(response.content))} downloaded)")
+        return True
+    except Exception as e:
+        print(f"Couldn't apply delta, falling back to MSync: {e}")
+        return False
+
 if __name__ == "__main__":
     try:
         version=sys.argv[1]
         github_url = sys.argv[2]
         name = sys.argv[3]
         appimage = sys.argv[4]
+        # In stage mode the app is already running: patch in the background into the staged file
+        stage = len(sys.argv) > 5 and sys.argv[5] == "--stage"
 
         print(f"{name} v.{version}")
         print(f"Checking for updates on {github_url}")
         
-        release = get_latest_release(github_url)
+        cache = HttpCache()
+        with metrics.phase("github.latest_release"):
+            release = get_latest_release(github_url, cache)
 
-        latest_version = release["tag_name"]
+        latest_version = get_latest_version(release, name, cache)
 
         if latest_version!=version:
             print(f"New version {latest_version} available")
-            msync_url = get_latest_msync_url(release)
+            msync_url = get_latest_msync_url(release, name)
+            with metrics.phase("msync.manifest"):
+                msync = MSync.from_bytes(cache.get(msync_url), msync_url)
+            # The version alone may be wrong (e.g. releases made before the per-app metadata), an
+            # AppImage that already is the published one must not be patched and relaunched forever
+            if MSync.calculate_file_hash(appimage, msync.file_hash) == msync.hash:
+                print("AppImage up to date")
+                touch_update_stamp()
+                sys.exit(0)
+            # Other versions of the app in ~/Applications can provide blocks too, MSYNC_SEEDS adds files
+            # or directories to look at (every AppImage in them is indexed)
+            seeds = MSync.find_seeds(["~/Applications"], [appimage], name) + [seed for seed in os.getenv("MSYNC_SEEDS", "").split(os.pathsep) if seed]
+
+            if stage:
+                staged = get_staged_path(appimage)
+                if os.path.isfile(staged) and MSync.calculate_file_hash(staged, msync.file_hash) == msync.hash:
+                    print(f"Version {latest_version} already staged")
+                    touch_update_stamp()
+                    sys.exit(0)
+
+                print(f"Staging AppImage update on '{staged}'")
+                if not apply_delta(release, name, version, msync, appimage, staged):
+                    msync.patch(appimage, seeds=seeds, output_path=staged)
+                print("Update will be applied on next launch")
+                touch_update_stamp()
+                sys.exit(0)
+
             subprocess.run(["notify-send", "Installing update", "Please wait, App will start automatically", "--icon", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.png")])
 
             print(f"Updating AppImage")
-
-            MSync.from_url(msync_url).patch(appimage)
+            if not apply_delta(release, name, version, msync, appimage, appimage):
+                msync.patch(appimage, seeds=seeds)
+            touch_update_stamp()
 
             print("Launching new instance")
             subprocess.run([appimage])
             sys.exit(1)
         else:
             print("AppImage up to date")
+            touch_update_stamp()
     except Exception:
         print(f"Error on autoupdate:\n{traceback.format_exc()}")
-        sys.exit(0)
\ No newline at end of file
+        sys.exit(0)
+    finally:
+        write_metrics(args = sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,80 @@
+import os
+import sys
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_modules.appimage_tool import AppImageTool
+from py_modules.msync import MSync
+
+APPIMAGETOOL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources", "appimagetool")
+
+def extract(appimage_path, pattern = None):
+    # Extraction runs the same squashfs reader as a mount, without needing FUSE
+    with tempfile.TemporaryDirectory(prefix = "appimage-bench-extract-") as tmp_dir:
+        command = [appimage_path, "--appimage-extract"] + ([pattern] if pattern else [])
+        t0 = time.perf_counter()
+        subprocess.run(command, cwd = tmp_dir, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+        return time.perf_counter() - t0
+
+def benchmark_appdir(appdir, codecs, runs):
+    results = []
+    with tempfile.TemporaryDirectory(prefix = "appimage-bench-") as tmp_dir:
+        for codec in codecs:
+            appimage_path = os.path.join(tmp_dir, f"bench-{codec}.AppImage")
+            build = []
+            first_read = []
+            full_read = []
+            for _ in range(runs):
+                if os.path.exists(appimage_path):
+                    os.remove(appimage_path)
+                build.append(AppImageTool.run_appimagetool(APPIMAGETOOL_PATH, appdir, appimage_path, codec))
+                # First read: superblock, directory table and AppRun, roughly what a launch pays before exec
+                first_read.append(extract(appimage_path, "AppRun"))
+                full_read.append(extract(appimage_path))
+            results.append({
+                "compression": codec,
+                "size": os.path.getsize(appimage_path),
+                "build_seconds": min(build),
+                "first_read_seconds": min(first_read),
+                "extract_seconds": min(full_read),
+            })
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Size, build time and read time of an AppDir packed with each squashfs codec")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--appdir", help="AppDir to pack")
+    group.add_argument("--appimage", help="AppImage whose contents are repacked")
+    parser.add_argument("--codecs", nargs="+", default=AppImageTool.compressions, help="Codecs to compare")
+    parser.add_argument("--runs", type=int, default=1, help="Runs per codec, the fastest one is reported")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    appdir = args.appdir
+    tmp_dir = None
+    if args.appimage is not None:
+        tmp_dir = tempfile.mkdtemp(prefix = "appimage-bench-source-")
+        subprocess.run([os.path.abspath(args.appimage), "--appimage-extract"], cwd = tmp_dir, stdout = subprocess.DEVNULL, check = True)
+        appdir = os.path.join(tmp_dir, "squashfs-root")
+
+    try:
+        print(f"Packing '{appdir}' with {', '.join(args.codecs)}")
+        results = benchmark_appdir(os.path.abspath(appdir), args.codecs, args.runs)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    print(f"{'Codec':<10}{'Size':>12}{'Build':>10}{'First read':>12}{'Extract':>10}")
+    for result in results:
+        print(f"{result['compression']:<10}{MSync.format_bytes(result['size']):>12}{result['build_seconds']:>9.2f}s"
+              f"{result['first_read_seconds']:>11.3f}s{result['extract_seconds']:>9.2f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"cpus": os.cpu_count(), "results": results}, f, indent=2)
@@ -0,0 +1,66 @@
+import os
+import sys
+import argparse
+import json
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_modules.msync import MSync
+
+def measure(function, size):
+    t0 = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - t0
+    return size / elapsed if elapsed > 0 else float("inf")
+
+def benchmark_file(file_path):
+    size = MSync.get_file_size(file_path)
+    with open(file_path, "rb") as f:
+        data = f.read(min(size, 64 * MSync.block_size))
+    blocks = [data[i:i + MSync.block_size] for i in range(0, len(data), MSync.block_size)]
+
+    results = []
+    for algorithm in MSync.hash_algorithms:
+        block_speed = measure(lambda: [MSync.calculate_block_hash(block, algorithm) for block in blocks], len(data))
+        file_speed = measure(lambda: MSync.file_digest(file_path, algorithm), size)
+        results.append({"algorithm": algorithm, "block_bytes_per_second": block_speed, "file_bytes_per_second": file_speed})
+
+    weak_speed = measure(lambda: [zlib.adler32(block) for block in blocks], len(data))
+    results.append({"algorithm": "adler32 (weak)", "block_bytes_per_second": weak_speed, "file_bytes_per_second": None})
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hashing throughput of the algorithms supported by MSync")
+    parser.add_argument("--file", help="File to hash, a random one is generated otherwise")
+    parser.add_argument("--size", type=int, default=256, help="Size in MB of the generated file")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    file_path = args.file
+    tmp_path = None
+    if file_path is None:
+        fd, tmp_path = tempfile.mkstemp(prefix="msync-hash-bench-")
+        with os.fdopen(fd, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+        file_path = tmp_path
+
+    try:
+        print(f"Hashing '{file_path}' ({MSync.format_bytes(MSync.get_file_size(file_path))}) on {os.cpu_count()} CPUs")
+        results = benchmark_file(file_path)
+    finally:
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+    print(f"{'Algorithm':<16}{'Blocks':>16}{'Whole file':>16}")
+    for result in results:
+        file_speed = result["file_bytes_per_second"]
+        file_speed = f"{MSync.format_bytes(file_speed)}/s" if file_speed is not None else "-"
+        print(f"{result['algorithm']:<16}{MSync.format_bytes(result['block_bytes_per_second']) + '/s':>16}{file_speed:>16}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"cpus": os.cpu_count(), "results": results}, f, indent=2)
@@ -0,0 +1,284 @@
+import os
+import sys
+import argparse
+import http.server
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_modules.msync import MSync
+
+SCENARIOS = ["append", "insert", "scattered", "recompressed", "replaced"]
+# Uncompressed size of a squashfs data block
+SQUASHFS_BLOCK = 128 * 1024
+
+class RangeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, latency = 0.0, bandwidth = None) -> None:
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.server.directory, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        size = os.path.getsize(path)
+
+        header = self.headers.get("Range")
+        ranges = []
+        if header and header.startswith("bytes="):
+            for part in header[6:].split(","):
+                first, _, last = part.strip().partition("-")
+                ranges.append((int(first), min(int(last), size - 1) + 1 if last else size))
+
+        with open(path, "rb") as f:
+            if not ranges:
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                self.send_range(f, 0, size)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+                self.send_header("Content-Length", str(end - start))
+                self.end_headers()
+                self.send_range(f, start, end)
+            else:
+                boundary = "MSYNCBENCH"
+                parts = [(f"--{boundary}\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes {start}-{end - 1}/{size}\r\n\r\n".encode(), start, end) for start, end in ranges]
+                closing = f"\r\n--{boundary}--\r\n".encode()
+                length = sum(len(head) + end - start for head, start, end in parts) + 2 * (len(parts) - 1) + len(closing)
+                self.send_response(206)
+                self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+                self.send_header("Content-Length", str(length))
+                self.end_headers()
+                for n, (head, start, end) in enumerate(parts):
+                    self.wfile.write((b"\r\n" if n else b"") + head)
+                    self.send_range(f, start, end)
+                self.wfile.write(closing)
+
+        with self.server.lock:
+            self.server.requests += 1
+
+    def send_range(self, f, start, end):
+        position = start
+        while position < end:
+            piece = os.pread(f.fileno(), min(MSync.stream_chunk_size, end - position), position)
+            t0 = time.perf_counter()
+            self.wfile.write(piece)
+            position += len(piece)
+            with self.server.lock:
+                self.server.bytes_sent += len(piece)
+            if self.server.bandwidth:
+                # Each connection is throttled on its own
+                delay = len(piece) / self.server.bandwidth - (time.perf_counter() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+
+def random_bytes(rng, size):
+    return rng.randbytes(size)
+
+def compressible_bytes(rng, size):
+    # Hex text compresses to about half, close to typical application payloads
+    return rng.randbytes((size + 1) // 2).hex().encode()[:size]
+
+def write_scenario(scenario, size, old_path, new_path, rng):
+    # Writes both versions and returns the bytes an ideal delta would need to transfer
+    if scenario == "recompressed":
+        return write_recompressed(size, old_path, new_path, rng)
+
+    base = random_bytes(rng, size)
+    if scenario == "append":
+        extra = random_bytes(rng, size // 25)
+        new = base + extra
+        ideal = len(extra)
+    elif scenario == "insert":
+        extra = random_bytes(rng, 1024 * 1024)
+        middle = size // 2
+        new = base[:middle] + extra + base[middle:]
+        ideal = len(extra)
+    elif scenario == "replaced":
+        # Nothing in common, every block is downloaded
+        new = random_bytes(rng, size)
+        ideal = size
+    elif scenario == "scattered":
+        new = bytearray(base)
+        edits = 32
+        for _ in range(edits):
+            offset = rng.randrange(0, size - 4096)
+            new[offset:offset + 4096] = random_bytes(rng, 4096)
+        new = bytes(new)
+        ideal = edits * 4096
+    else:
+        raise ValueError(f"Unknown scenario '{scenario}'")
+
+    with open(old_path, "wb") as f:
+        f.write(base)
+    with open(new_path, "wb") as f:
+        f.write(new)
+    return ideal
+
+def write_recompressed(size, old_path, new_path, rng):
+    # squashfs-like image: independently compressed data blocks. The new version changes some
+    # source blocks and adds a file in the middle, so the blocks after it move
+    source = [compressible_bytes(rng, SQUASHFS_BLOCK) for _ in range(max(size // (SQUASHFS_BLOCK // 2), 4))]
+    changed = list(source)
+    for n in rng.sample(range(len(changed)), max(len(changed) // 50, 1)):
+        changed[n] = compressible_bytes(rng, SQUASHFS_BLOCK)
+    middle = len(changed) // 2
+    changed[middle:middle] = [compressible_bytes(rng, SQUASHFS_BLOCK) for _ in range(8)]
+
+    old_blocks = [zlib.compress(block, 6) for block in source]
+    new_blocks = [zlib.compress(block, 6) for block in changed]
+    with open(old_path, "wb") as f:
+        f.write(b"".join(old_blocks))
+    with open(new_path, "wb") as f:
+        f.write(b"".join(new_blocks))
+
+    known = set(old_blocks)
+    return sum(len(block) for block in new_blocks if block not in known)
+
+def run_worker(manifest_url, file_path):
+    # Runs in its own process so peak RSS only accounts for the patch
+    t0 = time.perf_counter()
+    msync = MSync.from_url(manifest_url)
+    msync.patch(file_path)
+    elapsed = time.perf_counter() - t0
+    ok = MSync.calculate_file_hash(file_path, msync.file_hash) == msync.hash
+    print(json.dumps({"seconds": elapsed, "peak_rss": get_peak_rss(), "ok": ok}))
+
+def get_peak_rss():
+    # ru_maxrss is inherited from the parent across fork and exec, VmHWM starts over with the new process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run_scenario(server, work_dir, scenario, chunking, size, rng):
+    serve_dir = server.directory
+    new_path = os.path.join(serve_dir, "bench.AppImage")
+    old_path = os.path.join(work_dir, "old.AppImage")
+    client_path = os.path.join(work_dir, "bench.AppImage")
+    ideal = write_scenario(scenario, size, old_path, new_path, rng)
+
+    t0 = time.perf_counter()
+    msync = MSync.from_binary(new_path, chunking)
+    generation_seconds = time.perf_counter() - t0
+    msync.to_file(new_path + ".msync")
+    msync.to_file(new_path + ".msync.bin", binary = True)
+
+    shutil.copy2(old_path, client_path)
+    server.reset()
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", server.url("bench.AppImage.msync.bin"), client_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Patch worker failed:\n{result.stderr}")
+    worker = json.loads(result.stdout.strip().splitlines()[-1])
+
+    new_size = os.path.getsize(new_path)
+    manifest_size = os.path.getsize(new_path + ".msync.bin")
+    # The manifest itself is not part of the delta
+    downloaded = server.bytes_sent - manifest_size
+    return {
+        "scenario": scenario,
+        "chunking": chunking,
+        "size": new_size,
+        "generation_bytes_per_second": new_size / generation_seconds if generation_seconds > 0 else None,
+        "manifest_json_size": os.path.getsize(new_path + ".msync"),
+        "manifest_binary_size": manifest_size,
+        "downloaded": downloaded,
+        "ideal": ideal,
+        "overhead": downloaded / ideal if ideal else None,
+        "requests": server.requests - 1,
+        "patch_seconds": worker["seconds"],
+        "peak_rss": worker["peak_rss"],
+        "verified": worker["ok"],
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        run_worker(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="End-to-end MSync benchmark against a local HTTP range server")
+    parser.add_argument("--size", type=int, default=64, help="Size in MB of the synthetic AppImages")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS, help="Changes between versions")
+    parser.add_argument("--chunking", nargs="+", default=["fixed", "cdc"], choices=["fixed", "cdc"], help="Manifest layouts to compare")
+    parser.add_argument("--latency", type=float, default=0, help="Latency added to every request, in milliseconds")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Bandwidth per connection in MB/s (0 is unlimited)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic data")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    serve_dir = tempfile.mkdtemp(prefix="msync-bench-serve-")
+    work_dir = tempfile.mkdtemp(prefix="msync-bench-client-")
+    server = RangeServer(serve_dir, args.latency / 1000, args.bandwidth * 1024 * 1024 or None)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        for scenario in args.scenarios:
+            for chunking in args.chunking:
+                print(f"Running '{scenario}' with {chunking} chunking")
+                result = run_scenario(server, work_dir, scenario, chunking, args.size * 1024 * 1024, random.Random(args.seed))
+                results.append(result)
+    finally:
+        server.shutdown()
+        shutil.rmtree(serve_dir)
+        shutil.rmtree(work_dir)
+
+    print(f"{'Scenario':<14}{'Chunking':<10}{'Hashing':>12}{'Manifest':>11}{'Downloaded':>12}{'Ideal':>11}{'Requests':>10}{'Patch':>9}{'Peak RSS':>11}")
+    for result in results:
+        hashing = f"{MSync.format_bytes(result['generation_bytes_per_second'])}/s" if result["generation_bytes_per_second"] else "-"
+        print(f"{result['scenario']:<14}{result['chunking']:<10}{hashing:>12}{MSync.format_bytes(result['manifest_binary_size']):>11}"
+              f"{MSync.format_bytes(result['downloaded']):>12}{MSync.format_bytes(result['ideal']):>11}{result['requests']:>10}"
+              f"{result['patch_seconds']:>8.2f}s{MSync.format_bytes(result['peak_rss']):>11}"
+              + ("" if result["verified"] else "  HASH MISMATCH"))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "cpus": os.cpu_count(),
+                "size": args.size * 1024 * 1024,
+                "latency_ms": args.latency,
+                "bandwidth_mb_s": args.bandwidth,
+                "results": results,
+            }, f, indent=2)
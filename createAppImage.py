@@ -1,24 +1,90 @@
 from py_modules.input_parameters import InputParameters
 from py_modules.appimage_tool import AppImageTool
 from py_modules.github_helper import GithubHelper
+from py_modules.metrics import metrics
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import json
 import os
 
+def build_app(parametros: InputParameters, base_release = None):
+    # Runs in a worker process: own AppImageTool temp dir and per-app prefixed outputs
+    metrics.reset()
+    github_helper = GithubHelper()
+    appimagetool = AppImageTool(github_helper)
+    try:
+        appimagetool.env_prefix = AppImageTool.get_env_prefix(parametros.name)
+        github_helper.set_github_env_variable(appimagetool.env_prefix + "APP_VERSION", parametros.version)
+        appimagetool.prepare_delta_base(parametros.name, base_release)
+        if os.getenv("INPUT_UPLOAD_RELEASE"):
+            github_helper.start_uploads(os.getenv("INPUT_UPLOAD_RELEASE"))
+
+        appimagetool.create_resources(parametros.name, parametros.version, parametros.icon, parametros.entrypoint, parametros.desktop, parametros.exclude)
+        appimagetool.create_appimage(parametros.name, parametros.version, compression = parametros.compression)
+        github_helper.wait_uploads()
+        return {"name": parametros.name, "version": parametros.version, "env_prefix": appimagetool.env_prefix}, metrics.to_dict()["phases"]
+    finally:
+        appimagetool.cleanup()
+
+def build_all(github_helper: GithubHelper):
+    # Parsed (version commands included) before the workers start: the update check and the delta base
+    # look at the latest release, which the upload release may replace
+    apps = [InputParameters.from_desktop_file(desktop_file, f"aux-{os.path.splitext(desktop_file)[0]}.desktop")
+            for desktop_file in InputParameters.find_desktop_files()]
+    github_helper.check_update_required([parametros.version for parametros in apps])
+    base_release = github_helper.get_latest_release() if os.getenv("INPUT_DELTA_BASE") == "release" else None
+    # Created once here, so the workers don't race to create the release
+    if os.getenv("INPUT_UPLOAD_RELEASE"):
+        github_helper.get_or_create_release(os.getenv("INPUT_UPLOAD_RELEASE"))
+
+    workers = min(int(os.getenv("INPUT_WORKERS") or "0") or os.cpu_count(), len(apps))
+    print(f"Building {len(apps)} AppImages with {workers} workers")
+
+    built = []
+    errors = []
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = {executor.submit(build_app, parametros, base_release): parametros for parametros in apps}
+        for future in as_completed(futures):
+            try:
+                app, phases = future.result()
+            except Exception as e:
+                print(f"Error building '{futures[future].name}': {e}")
+                errors.append(e)
+                continue
+            print(f"Built {app['name']} {app['version']}")
+            metrics.add_phases(phases, app["name"])
+            built.append(app)
+
+    if errors:
+        raise errors[0]
+
+    github_helper.set_github_out_variable("apps", json.dumps(built, separators=(",", ":")))
+
 if __name__ == "__main__":
     github_helper = GithubHelper()
     appimagetool = AppImageTool(github_helper)
 
     os.chdir(os.getenv("GITHUB_WORKSPACE"))
     try:
-        parametros = InputParameters.from_desktop_file()
+        if os.getenv("INPUT_MULTI_APP") == "true":
+            build_all(github_helper)
+        else:
+            parametros = InputParameters.from_desktop_file()
+
+            github_helper.check_update_required(parametros.version)
+            github_helper.set_github_env_variable("APP_VERSION", parametros.version)
+            github_helper.set_github_out_variable("version", parametros.version)
 
-        github_helper.check_update_required(parametros.version)
-        github_helper.set_github_env_variable("APP_VERSION", parametros.version)
-        github_helper.set_github_out_variable("version", parametros.version)
+            # Both look at the latest release, before the upload release may replace it
+            appimagetool.prepare_delta_base(parametros.name)
+            if os.getenv("INPUT_UPLOAD_RELEASE"):
+                github_helper.start_uploads(os.getenv("INPUT_UPLOAD_RELEASE"))
 
-        appimagetool.create_resources(parametros.name, parametros.version, parametros.icon, parametros.entrypoint, parametros.desktop)
-        appimagetool.create_appimage(parametros.name, parametros.version)
+            appimagetool.create_resources(parametros.name, parametros.version, parametros.icon, parametros.entrypoint, parametros.desktop, parametros.exclude)
+            appimagetool.create_appimage(parametros.name, parametros.version, compression = parametros.compression)
+            github_helper.wait_uploads()
     except Exception as e:
         raise e
     finally:
-        appimagetool.cleanup()
\ No newline at end of file
+        github_helper.publish_metrics(os.path.join(appimagetool.working_dir, "build-metrics.json"), "AppImage build")
+        appimagetool.cleanup()
@@ -36,39 +36,24 @@ def find_appimage():
         
     return None
 
-def modify_squashfs_root(appimagetool:AppImageTool, appname:str, latest_url:str):
-    print("Modifying squashfs-root")
-    pwd = os.getcwd()
-    os.chdir("squashfs-root")
-
-    os.remove("AppRun")
-    os.remove(".DirIcon")
-    statics = ["usr", f"{appname.lower()}.png", f"{appname.lower()}.desktop"]
-    os.mkdir(appname)
-
-    files = os.listdir(".")
-    for file in files:
-        if file not in statics and file != appname:
-            shutil.move(file, os.path.join(appname, file))
-
-    shutil.copy2(appimagetool.apprun_file, os.path.basename(appimagetool.apprun_file))
-    autoupdate_folder = os.path.abspath(os.path.join(".","usr","bin","autoupdate"))
-    py_modules_folder = os.path.join(autoupdate_folder,"py_modules")
-    os.makedirs(autoupdate_folder)
-    shutil.copy2(appimagetool.autoup_file, os.path.join(autoupdate_folder, os.path.basename(appimagetool.autoup_file)))
-    os.makedirs(py_modules_folder)
-    shutil.copy2(appimagetool.msync_file, os.path.join(py_modules_folder, os.path.basename(appimagetool.msync_file)))
-
-    shutil.move(appname, os.path.join("usr", "bin", appname))
+def prepare_overlay(appimagetool:AppImageTool, appimage:str, appname:str, latest_url:str):
+    # Only the entries that change are written, the original tree is kept as-is under '<appname>/'
+    print("Preparing AppImage overlay")
+    overlay = appimagetool.tmp_path
+    desktop_file = f"{appname.lower()}.desktop"
+    icon_file = f"{appname.lower()}.png"
+    appimagetool.extract_entries(appimage, overlay, [desktop_file, icon_file])
+    shutil.copy2(os.path.join(overlay, icon_file), os.path.join(overlay, ".DirIcon"))
 
     print("Modifying desktop file")
-    desktop = DesktopParser(f"{appname.lower()}.desktop")
+    desktop = DesktopParser(os.path.join(overlay, desktop_file))
     desktop.data["Desktop Entry"]["Exec"] = f"{appname}/{appname.lower()}"
     desktop.data["Desktop Entry"]["X-GitHub-Api"] = latest_url
-    desktop.persist(f"{appname.lower()}.desktop")
+    desktop.data["Desktop Entry"]["X-AppImage-Update-Mode"] = appimagetool.update_mode
+    desktop.persist(os.path.join(overlay, desktop_file))
+    appimagetool.write_launch_file(overlay, desktop, f"{appname}/{appname.lower()}", appname)
 
-    os.chdir(pwd)
-    shutil.move("squashfs-root", appname)
+    return overlay, desktop.data["Desktop Entry"]["X-AppImage-Version"]
 
 if __name__ == "__main__":
     github_helper = GithubHelper()
@@ -83,14 +68,16 @@ if __name__ == "__main__":
             raise FileNotFoundError("AppImage file not found")
         
         remove_unneeded_dist_entries()
-        appimagetool.extract_appimage(appimage)
-        modify_squashfs_root(appimagetool, appname, github_helper.latest_url)
-
-        desktop = DesktopParser(os.path.join(appname, f"{appname.lower()}.desktop"))
-        version = desktop.data["Desktop Entry"]["X-AppImage-Version"]
-
-        appimagetool.create_appimage(appname, version, os.path.abspath(appname))
+        # Before the upload release may replace the latest one
+        appimagetool.prepare_delta_base(appname)
+        if os.getenv("INPUT_UPLOAD_RELEASE"):
+            github_helper.start_uploads(os.getenv("INPUT_UPLOAD_RELEASE"))
+        overlay, version = prepare_overlay(appimagetool, appimage, appname, github_helper.latest_url)
+
+        appimagetool.repack_appimage(appname, version, appimage, overlay, appname)
+        github_helper.wait_uploads()
     except Exception as e:
         raise e
     finally:
+        github_helper.publish_metrics(os.path.join(appimagetool.working_dir, "build-metrics.json"), "Electron AppImage repack")
         appimagetool.cleanup()
\ No newline at end of file
@@ -1,25 +1,33 @@
 from py_modules.github_helper import GithubHelper
+from concurrent.futures import ThreadPoolExecutor
 
+import os
 import requests
 import sys
 
+def run_concurrently(executor, *calls):
+    # Waits for every call and raises the first error
+    futures = [executor.submit(call, *args) for call, *args in calls]
+    return [future.result() for future in futures]
+
 if __name__ == "__main__":
+    helper = GithubHelper()
     try:
-        helper = GithubHelper()
-
-        helper.delete_release("latest")
-        helper.delete_tag("latest")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # The commit for the new tags is resolved while the old release is removed
+            run_concurrently(executor, (helper.delete_release, "latest"), (helper.get_default_branch_sha,))
 
-        # Obtener la última versión y calcular la nueva
-        latest_version = helper.get_latest_version()
-        new_version = helper.increment_version(latest_version)
+            # Obtener la última versión y calcular la nueva (con la release 'latest' ya borrada)
+            latest_version, _ = run_concurrently(executor, (helper.get_latest_version,), (helper.delete_tag, "latest"))
+            new_version = helper.increment_version(latest_version)
 
-        # Crear nueva tag y release
-        helper.create_tag(new_version)
-        helper.create_release(new_version)
-        helper.create_tag("latest")
-        helper.create_release("latest")
+            # Crear nueva tag y release, 'latest' se crea la última para que sea la release más reciente
+            run_concurrently(executor, (helper.create_tag, new_version), (helper.create_tag, "latest"))
+            helper.create_release(new_version)
+            helper.create_release("latest")
 
     except requests.exceptions.RequestException as e:
         print(f"Error en la API de GitHub: {e}")
         sys.exit(1)
+    finally:
+        helper.publish_metrics(os.path.abspath("release-metrics.json"), "GitHub release")
@@ -1,32 +1,60 @@
+from .blockmap import BlockMap
+from .build_cache import BuildCache
 from .github_helper import GithubHelper
 from .desktop_parser import DesktopParser
+from .metrics import metrics
+from .msdelta import MSDelta
 from .msync import MSync
 from datetime import datetime
 
 import base64
+import fnmatch
 import hashlib
-import math
 import os
 import re
+import requests
+import shlex
 import shutil
+import struct
 import subprocess
 import tempfile
+import time
 import yaml
 
 class AppImageTool:
+    # py_modules needed by autoupdate.py inside the AppImage
+    client_modules = ["msync.py", "msdelta.py", "http_cache.py", "metrics.py"]
+    # Squashfs codecs the bundled appimagetool (and the runtime it embeds) can handle
+    compressions = ["gzip", "xz"]
+    # Files generated for every AppImage, next to it
+    artifact_suffixes = ["", ".zsync", ".msync", ".msync.bin", ".blockmap"]
+
     def __init__(self, github_helper: GithubHelper) -> None:
         self.github_helper = github_helper
         self.working_dir = github_helper.action_path
         self.appimagetool_path = os.path.join(self.working_dir, "resources", "appimagetool")
         self.apprun_local_file = os.path.join(self.working_dir, "resources", "AppRun")
         self.autoup_local_file = os.path.join(self.working_dir, "autoupdate.py")
-        self.msync_local_file = os.path.join(self.working_dir, "py_modules","msync.py")
+        # Set for multi-app builds, so every app gets its own environment variables and latest-linux.yml
+        self.env_prefix = ""
+        self.update_mode = os.getenv("INPUT_UPDATE_MODE") or "blocking"
+        self.update_check_interval = int(os.getenv("INPUT_UPDATE_CHECK_INTERVAL") or "0")
+        self.compression = os.getenv("INPUT_COMPRESSION") or "gzip"
+        # Only electron-updater reads blockmaps, other apps update through zsync and msync
+        blockmap = os.getenv("INPUT_BLOCKMAP") or "auto"
+        self.blockmap = blockmap == "true" or (blockmap == "auto" and os.getenv("INPUT_IS_ELECTRON") == "true")
+        self.exclude = AppImageTool.parse_patterns(os.getenv("INPUT_EXCLUDE") or "")
+        build_cache_dir = os.getenv("INPUT_BUILD_CACHE")
+        self.build_cache = BuildCache(os.path.abspath(build_cache_dir), copy_function = AppImageTool.copy_file) if build_cache_dir else None
+        # 'release' (the AppImage of the latest release) or a local AppImage, or directory holding it
+        self.delta_base = os.getenv("INPUT_DELTA_BASE")
+        self.delta_base_file = None
+        self.delta_dir = None
         self.tmp_path = tempfile.mkdtemp(prefix = "create-appimage-")
         self.apprun_file = os.path.join(self.tmp_path, "AppRun")
         self.autoup_folder = os.path.join(self.tmp_path, "usr", "bin", "autoupdate")
         self.autoup_file = os.path.join(self.autoup_folder, "autoupdate.py")
         self.pymod_file = os.path.join(self.autoup_folder, "py_modules")
-        self.msync_file = os.path.join(self.pymod_file, "msync.py")
         print(f"Using tmp file '{self.tmp_path}'")
         
         shutil.copy2(self.apprun_local_file, self.apprun_file)
@@ -34,11 +62,12 @@ class AppImageTool:
         os.makedirs(self.autoup_folder)
         shutil.copy2(self.autoup_local_file, self.autoup_file)
         os.makedirs(self.pymod_file)
-        shutil.copy2(self.msync_local_file, self.msync_file)
+        for module in self.client_modules:
+            shutil.copy2(os.path.join(self.working_dir, "py_modules", module), os.path.join(self.pymod_file, module))
 
         os.chmod(self.apprun_file, 0o777)
 
-    def create_resources(self, name, version, icon, entrypoint, desktop):
+    def create_resources(self, name, version, icon, entrypoint, desktop, exclude = []):
         prev_cwd=os.getcwd()
         os.chdir(self.tmp_path)
         srcDir = os.path.dirname(entrypoint)
@@ -46,7 +75,7 @@ class AppImageTool:
         logoPath = os.path.abspath(os.path.join(".","logo.png"))
         desktop_entry = os.path.join(self.tmp_path, f"{name}.desktop")
         
-        shutil.copytree(srcDir, usrBin)
+        AppImageTool.stage_tree(srcDir, usrBin, self.exclude + exclude)
 
         shutil.copy2(icon, logoPath)
 
@@ -63,11 +92,13 @@ class AppImageTool:
 
         desktop = DesktopParser(desktop_entry)
         desktop.data["Desktop Entry"]["X-GitHub-Api"] = self.github_helper.latest_url
+        desktop.data["Desktop Entry"]["X-AppImage-Update-Mode"] = self.update_mode
         desktop.persist(desktop_entry)
+        self.write_launch_file(self.tmp_path, desktop)
 
         os.chdir(prev_cwd)
 
-    def create_appimage(self, name, version, directory = None):
+    def create_appimage(self, name, version, directory = None, compression = None):
         prev_cwd=os.getcwd()
 
         directory = self.tmp_path if directory is None else directory
@@ -75,58 +106,361 @@ class AppImageTool:
 
         file_name = re.sub(r"[^a-zA-Z0-9]", "-", name)
         appimage_path = os.path.join(self.working_dir, f"{file_name}.AppImage")
-        print(f"Generating AppImage file '{file_name}'")
-        command = (
-            f'ARCH=x86_64 {self.appimagetool_path} --comp gzip {directory} "{appimage_path}" '
-            f'-u "gh-releases-zsync|{self.github_helper.repo.replace("/", "|")}|latest|'
-            f'{file_name}.AppImage.zsync"'
-        )
-        print(f"Running '{command}'")
-        
-        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            print(f"Error while running command:\n{result.stderr}")
-            raise RuntimeError(f"Command finished with exit code {result.returncode}")
+        compression = compression or self.compression
+        update_info = f'gh-releases-zsync|{self.github_helper.repo.replace("/", "|")}|latest|{file_name}.AppImage.zsync'
+        artifacts = [appimage_path + suffix for suffix in AppImageTool.artifact_suffixes if self.blockmap or suffix != ".blockmap"]
 
-        shutil.move(os.path.join(directory, f"{os.path.basename(appimage_path)}.zsync"), f"{appimage_path}.zsync")
+        cache_key = None
+        cached = None
+        if self.build_cache is not None:
+            with metrics.phase("build_cache.key"):
+                cache_key = self.build_cache.key(directory, {
+                    "file_name": file_name,
+                    "compression": AppImageTool.parse_compression(compression),
+                    "update_info": update_info,
+                    "appimagetool": MSync.file_digest(self.appimagetool_path, "sha256").hexdigest(),
+                    "msync": self.get_msync_options(),
+                    "blockmap": self.blockmap,
+                    "action": self.get_action_digest(),
+                    "zsyncmake": AppImageTool.get_zsyncmake_version(),
+                }, file_name)
+            with metrics.phase("build_cache.restore"):
+                cached = self.build_cache.restore(cache_key, artifacts)
 
-        print(f"Generating MSync file '{appimage_path}.msync'")
-        MSync.from_binary(appimage_path).to_file(appimage_path+".msync")
-        
-        self.github_helper.set_github_env_variable("APPIMAGE_PATH", appimage_path)
-        self.github_helper.set_github_env_variable("MSYNC_PATH", appimage_path+".msync")
-        
-        latest_linux_path = os.path.join(self.working_dir, "latest-linux.yml")
-        print("Generating latest-linux.yml")
+        if cached is None:
+            # Outputs of a previous build are replaced instead of overwritten
+            for artifact in artifacts:
+                if os.path.exists(artifact):
+                    os.remove(artifact)
+            print(f"Generating AppImage file '{file_name}' with {compression} compression")
+            with metrics.phase("appimagetool") as record:
+                elapsed = AppImageTool.run_appimagetool(self.appimagetool_path, directory, appimage_path, compression, update_info)
+                record["bytes"] = os.path.getsize(appimage_path)
+            print(f"AppImage built in {elapsed:.1f}s ({MSync.format_bytes(os.path.getsize(appimage_path))})")
+
+            # Embedding the blockmap changes the file, the zsync from appimagetool is regenerated afterwards
+            os.remove(os.path.join(directory, f"{os.path.basename(appimage_path)}.zsync"))
+            sha512, blockmap_size = self.write_blockmap(appimage_path)
+            self.write_zsync(file_name, appimage_path)
+            self.write_msync(appimage_path)
+            if cache_key is not None:
+                with metrics.phase("build_cache.store"):
+                    self.build_cache.store(cache_key, artifacts, {"sha512": sha512, "blockMapSize": blockmap_size})
+        else:
+            sha512 = cached["sha512"]
+            blockmap_size = cached["blockMapSize"]
+            for artifact in artifacts:
+                self.github_helper.upload_asset(artifact)
 
-        sha512 = self.get_sha512(appimage_path)
+        self.write_delta(name, version, appimage_path)
+        self.publish_appimage(file_name, version, appimage_path, sha512, blockmap_size)
+
+        os.chdir(prev_cwd)
+
+    def repack_appimage(self, name, version, appimage, overlay, root_name):
+        # Appends the overlay to a clone of the image, the original tree becomes '<root_name>/' and is never recompressed
+        file_name = re.sub(r"[^a-zA-Z0-9]", "-", name)
+        appimage_path = os.path.join(self.working_dir, f"{file_name}.AppImage")
+        offset, sections = AppImageTool.read_runtime(appimage)
+        print(f"Repacking '{appimage}' into '{appimage_path}' (squashfs at offset {offset})")
+
+        t0 = time.perf_counter()
+        with metrics.phase("repack") as record:
+            MSync.clone_file(appimage, appimage_path)
+            os.chmod(appimage_path, 0o755)
+            AppImageTool.run_command(
+                f'mksquashfs "{overlay}" "{appimage_path}" -offset {offset} -root-becomes "{root_name}" '
+                f'-all-root -no-recovery -no-progress'
+            )
+            record["bytes"] = os.path.getsize(appimage_path)
+
+        update_info = f'gh-releases-zsync|{self.github_helper.repo.replace("/", "|")}|latest|{file_name}.AppImage.zsync'
+        if ".upd_info" in sections:
+            section_offset, section_size = sections[".upd_info"]
+            with open(appimage_path, "r+b") as file:
+                file.seek(section_offset)
+                file.write(update_info.encode().ljust(section_size, b"\0")[:section_size])
+        else:
+            print("Runtime has no .upd_info section, update information not embedded")
+        print(f"AppImage repacked in {time.perf_counter() - t0:.1f}s ({MSync.format_bytes(os.path.getsize(appimage_path))})")
+
+        sha512, blockmap_size = self.write_blockmap(appimage_path)
+        self.write_zsync(file_name, appimage_path)
+        self.write_msync(appimage_path)
+        self.write_delta(name, version, appimage_path)
+        self.publish_appimage(file_name, version, appimage_path, sha512, blockmap_size)
+
+    def prepare_delta_base(self, name, release = None):
+        # Must run before anything is uploaded: the new release may become the latest one or replace the base asset
+        if not self.delta_base:
+            return
+        file_name = re.sub(r"[^a-zA-Z0-9]", "-", name)
+        version = None
+        try:
+            if self.delta_base == "release":
+                release = release or self.github_helper.get_latest_release()
+                asset = next((asset for asset in (release or {}).get("assets", []) if asset["name"] == f"{file_name}.AppImage"), None)
+                if asset is None:
+                    raise FileNotFoundError(f"No '{file_name}.AppImage' in the latest release")
+                self.delta_dir = tempfile.mkdtemp(prefix = "appimage-delta-")
+                path = os.path.join(self.delta_dir, asset["name"])
+                self.github_helper.download_asset(asset, path)
+                version = release["tag_name"]
+            else:
+                path = os.path.abspath(self.delta_base)
+                if os.path.isdir(path):
+                    path = os.path.join(path, f"{file_name}.AppImage")
+                if not os.path.isfile(path):
+                    raise FileNotFoundError(f"'{path}' not found")
+
+            # The client passes the version in its .launch file, the tag is only a fallback for older images
+            version = AppImageTool.read_launch_values(path).get("APP_VERSION") or version
+            if not version:
+                raise ValueError(f"Unknown version for '{path}'")
+            self.delta_base_file = (path, version)
+            print(f"Using '{path}' (version {version}) as delta base")
+        except (OSError, ValueError, RuntimeError, requests.RequestException) as e:
+            print(f"No delta base, the delta file won't be generated: {e}")
+
+    def write_delta(self, name, version, appimage_path):
+        if self.delta_base_file is None:
+            return
+        base_path, base_version = self.delta_base_file
+        if base_version == version:
+            print(f"Delta base has the same version {version}, skipping delta")
+            return
+
+        delta_path = os.path.join(self.working_dir, MSDelta.get_asset_name(name, base_version))
+        print(f"Generating delta '{delta_path}' from version {base_version}")
+        delta = MSDelta.create(base_path, appimage_path, base_version, self.get_msync_options()[2])
+        if delta is None:
+            return
+        delta.to_file(delta_path)
+        print(f"Delta size {MSync.format_bytes(os.path.getsize(delta_path))} ({MSync.format_bytes(os.path.getsize(appimage_path))} AppImage)")
+        self.github_helper.set_github_env_variable(self.env_prefix + "DELTA_PATH", delta_path)
+        self.github_helper.upload_asset(delta_path)
+
+    def write_blockmap(self, appimage_path):
+        if not self.blockmap:
+            with metrics.phase("sha512", os.path.getsize(appimage_path)):
+                sha512 = MSync.file_digest(appimage_path, "sha512")
+            self.github_helper.upload_asset(appimage_path)
+            return base64.b64encode(sha512.digest()).decode('utf-8'), None
+
+        # Chunking pass also feeds the sha512 of latest-linux.yml, the embedded blockmap is added to it afterwards
+        print(f"Generating blockmap '{appimage_path}.blockmap'")
+        sha512 = hashlib.sha512()
+        with metrics.phase("blockmap", os.path.getsize(appimage_path)):
+            blockmap = BlockMap.from_file(appimage_path, sha512)
+            blockmap.to_file(appimage_path + ".blockmap")
+            blockmap_size = blockmap.embed(appimage_path, sha512)
+        # The AppImage is final once the blockmap is embedded, its upload overlaps the zsync and msync generation
+        self.github_helper.upload_asset(appimage_path)
+        self.github_helper.upload_asset(appimage_path + ".blockmap")
+        return base64.b64encode(sha512.digest()).decode('utf-8'), blockmap_size
+
+    def write_zsync(self, file_name, appimage_path):
+        prev_cwd=os.getcwd()
+        os.chdir(self.working_dir)
+        with metrics.phase("zsync", os.path.getsize(appimage_path)):
+            AppImageTool.run_command(f'zsyncmake -u "{file_name}.AppImage" -o "{appimage_path}.zsync" "{appimage_path}"')
+        os.chdir(prev_cwd)
+        self.github_helper.upload_asset(appimage_path + ".zsync")
+
+    def get_action_digest(self):
+        # Code generating the artifacts (and bundled in the AppImage), a change invalidates cached builds
+        digest = hashlib.sha256()
+        modules_dir = os.path.join(self.working_dir, "py_modules")
+        paths = [os.path.join(modules_dir, name) for name in sorted(os.listdir(modules_dir)) if name.endswith(".py")]
+        for path in paths + [self.autoup_local_file, self.apprun_local_file]:
+            digest.update(os.path.relpath(path, self.working_dir).encode() + b"\0")
+            digest.update(MSync.file_digest(path, "sha256").digest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_zsyncmake_version():
+        result = subprocess.run(["zsyncmake", "-V"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        return result.stdout.split("\n")[0].strip()
+
+    def get_msync_options(self):
+        chunking = os.getenv("INPUT_MSYNC_CHUNKING") or "fixed"
+        block_hash = os.getenv("INPUT_MSYNC_BLOCK_HASH") or MSync.default_block_hash
+        file_hash = os.getenv("INPUT_MSYNC_FILE_HASH") or MSync.default_file_hash
+        return chunking, block_hash, file_hash
+
+    def write_msync(self, appimage_path):
+        chunking, block_hash, file_hash = self.get_msync_options()
+        print(f"Generating MSync file '{appimage_path}.msync' using {chunking} chunking ({block_hash}/{file_hash})")
+        msync = MSync.from_binary(appimage_path, chunking, block_hash, file_hash)
+        msync.to_file(appimage_path+".msync")
+        # Binary manifest is published alongside, clients older than the format only look for '.msync'
+        msync.to_file(appimage_path+".msync.bin", binary = True)
+        self.github_helper.upload_asset(appimage_path + ".msync")
+        self.github_helper.upload_asset(appimage_path + ".msync.bin")
+
+    def publish_appimage(self, file_name, version, appimage_path, sha512, blockmap_size):
+        self.github_helper.set_github_env_variable(self.env_prefix + "APPIMAGE_PATH", appimage_path)
+        self.github_helper.set_github_env_variable(self.env_prefix + "MSYNC_PATH", appimage_path+".msync")
+        self.github_helper.set_github_env_variable(self.env_prefix + "MSYNC_BIN_PATH", appimage_path+".msync.bin")
+        if blockmap_size is not None:
+            self.github_helper.set_github_env_variable(self.env_prefix + "BLOCKMAP_PATH", appimage_path+".blockmap")
+        
+        latest_linux_name = f"{file_name}-latest-linux.yml" if self.env_prefix else "latest-linux.yml"
+        latest_linux_path = os.path.join(self.working_dir, latest_linux_name)
+        print(f"Generating {latest_linux_name}")
 
         data={}
         data["version"] = version
-        data["files"] = {}
-        data["files"]["url"] = file_name + ".AppImage"
-        data["files"]["sha512"] = sha512
-        data["files"]["size"] = os.path.getsize(appimage_path)
-        data["files"]["blockMapSize"] = math.floor(data["files"]["size"]/1024)
+        data["files"] = [{}]
+        data["files"][0]["url"] = file_name + ".AppImage"
+        data["files"][0]["sha512"] = sha512
+        data["files"][0]["size"] = os.path.getsize(appimage_path)
+        if blockmap_size is not None:
+            data["files"][0]["blockMapSize"] = blockmap_size
         data["path"] = file_name + ".AppImage"
         data["sha512"] = sha512
         data["releaseDate"] = self.get_release_date(appimage_path)
                 
         with open(latest_linux_path, "w") as file:
                 yaml.dump(data, file, default_flow_style=False, sort_keys=False)
-        self.github_helper.set_github_env_variable("LATEST_LINUX_PATH", latest_linux_path)
+        self.github_helper.set_github_env_variable(self.env_prefix + "LATEST_LINUX_PATH", latest_linux_path)
+        self.github_helper.upload_asset(latest_linux_path)
 
-        os.chdir(prev_cwd)
+    @staticmethod
+    def get_env_prefix(name):
+        return re.sub(r"[^A-Z0-9]", "_", name.upper()) + "_"
+
+    @staticmethod
+    def parse_patterns(value: str):
+        return [pattern.strip() for pattern in re.split(r"[\n,;]", value) if pattern.strip()]
+
+    @staticmethod
+    def stage_file(src, dst):
+        # Hardlink when possible, otherwise reflink/copy (different filesystems, protected files...)
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+        return AppImageTool.copy_file(src, dst)
+
+    @staticmethod
+    def copy_file(src, dst):
+        # Reflink or kernel copy, never a hardlink: rewriting one of the files must not change the other
+        MSync.clone_file(src, dst)
+        shutil.copystat(src, dst)
+        return dst
+
+    @staticmethod
+    def stage_tree(src, dst, exclude = []):
+        print(f"Staging '{src}' into '{dst}'" + (f" excluding {', '.join(exclude)}" if exclude else ""))
+        t0 = time.perf_counter()
+
+        def ignore(directory, names):
+            # Patterns match either the file name or its path relative to the source dir
+            rel_dir = os.path.relpath(directory, src)
+            ignored = set()
+            for name in names:
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                if any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in exclude):
+                    ignored.add(name)
+            return ignored
 
-    def extract_appimage(self, file):
-        command = f"{file} --appimage-extract"
+        with metrics.phase("stage") as record:
+            shutil.copytree(src, dst, ignore = ignore if exclude else None, copy_function = AppImageTool.stage_file)
+            record["bytes"] = sum(os.lstat(os.path.join(root, name)).st_size for root, _, files in os.walk(dst) for name in files)
+        print(f"Staged in {time.perf_counter() - t0:.1f}s")
+
+    @staticmethod
+    def parse_compression(value: str) -> str:
+        codec, _, level = value.strip().lower().partition(":")
+        if codec not in AppImageTool.compressions:
+            raise ValueError(f"Unsupported compression '{value}', appimagetool only supports: {', '.join(AppImageTool.compressions)}")
+        if level:
+            raise ValueError(f"Compression level '{level}' not supported, appimagetool uses the mksquashfs defaults")
+        return codec
+
+    @staticmethod
+    def run_appimagetool(appimagetool_path, directory, appimage_path, compression = "gzip", update_info = None):
+        command = f'ARCH=x86_64 {appimagetool_path} --comp {AppImageTool.parse_compression(compression)} {directory} "{appimage_path}"'
+        if update_info is not None:
+            command += f' -u "{update_info}"'
+
+        t0 = time.perf_counter()
+        AppImageTool.run_command(command)
+        return time.perf_counter() - t0
+
+    @staticmethod
+    def run_command(command):
         print(f"Running '{command}'")
-        
         result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if result.returncode != 0:
             print(f"Error while running command:\n{result.stderr}")
             raise RuntimeError(f"Command finished with exit code {result.returncode}")
 
+    @staticmethod
+    def read_runtime(appimage):
+        # The squashfs starts right after the runtime ELF, which ends with its section header table
+        with open(appimage, "rb") as file:
+            header = file.read(64)
+            if header[:4] != b"\x7fELF" or header[4] != 2:
+                raise ValueError(f"'{appimage}' is not a 64-bit AppImage")
+            sh_offset, = struct.unpack_from("<Q", header, 0x28)
+            sh_entry_size, sh_count, sh_names = struct.unpack_from("<HHH", header, 0x3A)
+
+            file.seek(sh_offset)
+            table = file.read(sh_entry_size * sh_count)
+            entries = [struct.unpack_from("<IIQQQQ", table, i * sh_entry_size) for i in range(sh_count)]
+            _, _, _, _, names_offset, names_size = entries[sh_names]
+            file.seek(names_offset)
+            names = file.read(names_size)
+
+        sections = {}
+        for name, _, _, _, offset, size in entries:
+            sections[names[name:names.index(b"\0", name)].decode()] = (offset, size)
+        return sh_offset + sh_entry_size * sh_count, sections
+
+    @staticmethod
+    def read_launch_values(appimage):
+        # .launch of a built AppImage, empty for images made before it existed
+        with tempfile.TemporaryDirectory(prefix = "appimage-launch-") as directory:
+            AppImageTool.extract_entries(appimage, directory, [".launch"])
+            launch_path = os.path.join(directory, ".launch")
+            if not os.path.isfile(launch_path):
+                return {}
+            values = {}
+            with open(launch_path, "r") as file:
+                for line in file:
+                    key, _, value = line.strip().partition("=")
+                    if key:
+                        values[key] = " ".join(shlex.split(value))
+            return values
+
+    @staticmethod
+    def extract_entries(appimage, directory, entries):
+        offset, _ = AppImageTool.read_runtime(appimage)
+        paths = " ".join(f'"{entry}"' for entry in entries)
+        with metrics.phase("extract_entries"):
+            AppImageTool.run_command(f'unsquashfs -o {offset} -f -d "{directory}" "{appimage}" {paths}')
+
+    def write_launch_file(self, directory, desktop: DesktopParser, exec_path = None, app_root = ""):
+        # Sourced by AppRun so it doesn't have to parse the desktop file on every start
+        entry = desktop.data["Desktop Entry"]
+        values = {
+            "APP_NAME": entry["Name"],
+            "APP_VERSION": entry.get("X-AppImage-Version", ""),
+            "GITHUB_API": entry["X-GitHub-Api"],
+            "UPDATE_MODE": entry.get("X-AppImage-Update-Mode", self.update_mode),
+            "UPDATE_CHECK_INTERVAL": str(self.update_check_interval),
+            # Relative to the AppDir root
+            "EXEC": exec_path or os.path.join("usr", "bin", entry["Exec"].split(" ")[0]),
+            "APP_ROOT": app_root,
+        }
+        launch_path = os.path.join(directory, ".launch")
+        print(f"Writing launch file '{launch_path}'")
+        with open(launch_path, "w") as file:
+            for key, value in values.items():
+                file.write(f"{key}={shlex.quote(value)}\n")
 
     def get_release_date(self, path):
         try:
@@ -137,16 +471,8 @@ class AppImageTool:
         dt = datetime.utcfromtimestamp(timestamp)
         return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
 
-    def get_sha512(self, path):
-        sha512 = hashlib.sha512()
-
-        with open(path, "rb") as archivo:
-            for bloque in iter(lambda: archivo.read(8192), b""):
-                sha512.update(bloque)
-        
-        hash_base64 = base64.b64encode(sha512.digest()).decode('utf-8')
-        return hash_base64
-
     def cleanup(self):
         print("Cleaning workspace and temporal files")
+        if self.delta_dir is not None:
+            shutil.rmtree(self.delta_dir, ignore_errors = True)
         
\ No newline at end of file
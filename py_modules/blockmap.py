@@ -0,0 +1,46 @@
+from .msync import MSync
+
+import base64
+import gzip
+import json
+import struct
+import zlib
+
+class BlockMap:
+    # electron-builder (app-builder) checksums are base64 BLAKE2b digests of 18 bytes
+    algorithm = "blake2b-144"
+
+    def __init__(self, checksums, sizes) -> None:
+        self.checksums = checksums
+        self.sizes = sizes
+
+    @staticmethod
+    def from_file(file_path, digest = None):
+        # Content-defined chunks, digest (if any) is updated with the whole file in the same pass
+        _, chunks = MSync._scan_blocks(file_path, "cdc", BlockMap.algorithm, digest = digest)
+        checksums = [base64.b64encode(bytes.fromhex(hash)).decode() for _, _, hash, _ in chunks]
+        sizes = [length for _, length, _, _ in chunks]
+        return BlockMap(checksums, sizes)
+
+    def to_bytes(self):
+        data = {
+            "version": "2",
+            "files": [{"name": "file", "offset": 0, "checksums": self.checksums, "sizes": self.sizes}],
+        }
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def to_file(self, file_path):
+        with open(file_path, "wb") as f:
+            f.write(gzip.compress(self.to_bytes()))
+
+    def embed(self, file_path, digest = None):
+        # electron-updater reads AppImage blockmaps from the end of the file:
+        # raw deflate data followed by its length as a big-endian uint32
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        data = compressor.compress(self.to_bytes()) + compressor.flush()
+        trailer = data + struct.pack(">I", len(data))
+        with open(file_path, "ab") as f:
+            f.write(trailer)
+        if digest is not None:
+            digest.update(trailer)
+        return len(data)
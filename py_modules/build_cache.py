@@ -0,0 +1,117 @@
+from .msync import MSync
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+class BuildCache:
+    def __init__(self, cache_dir, max_entries = 3, copy_function = shutil.copy2) -> None:
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.copy_function = copy_function
+
+    def key(self, directory, options, name = "files"):
+        # Build options first so a change in them never matches a previous tree
+        digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+        digest.update(self.tree_hash(directory, name).encode())
+        return digest.hexdigest()
+
+    def tree_hash(self, directory, name = "files"):
+        # Each name (app) keeps its own digest index, so builds sharing the cache don't drop each other's
+        t0 = time.perf_counter()
+        index_path = os.path.join(self.cache_dir, f"{name}.index.json")
+        index = self._load_index(index_path)
+        new_index = {}
+        digest = hashlib.sha256()
+
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for entry in sorted(dirs + files):
+                path = os.path.join(root, entry)
+                info = os.lstat(path)
+                rel_path = os.path.relpath(path, directory)
+                digest.update(f"{rel_path}\0{stat.S_IFMT(info.st_mode)}\0{stat.S_IMODE(info.st_mode)}\0".encode())
+                if stat.S_ISLNK(info.st_mode):
+                    digest.update(os.readlink(path).encode())
+                elif stat.S_ISREG(info.st_mode):
+                    # Unchanged files (same inode, size and mtime) aren't read again, staging hardlinks keep them stable
+                    stat_key = f"{info.st_dev}:{info.st_ino}:{info.st_size}:{info.st_mtime_ns}"
+                    file_digest = index.get(stat_key) or MSync.file_digest(path, "sha256").hexdigest()
+                    new_index[stat_key] = file_digest
+                    digest.update(file_digest.encode())
+                digest.update(b"\n")
+
+        self._write_json(index_path, new_index)
+        print(f"Tree hash of '{directory}' computed in {time.perf_counter() - t0:.1f}s")
+        return digest.hexdigest()
+
+    def restore(self, key, paths):
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        for path in paths:
+            cached_path = os.path.join(entry_dir, os.path.basename(path))
+            if not os.path.isfile(cached_path):
+                return None
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+            self.copy_function(os.path.join(entry_dir, os.path.basename(path)), path)
+
+        os.utime(entry_dir)
+        print(f"Restored {len(paths)} artifacts from build cache entry {key[:12]}")
+        return meta
+
+    def store(self, key, paths, meta):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Filled in a temporary dir and renamed, a half written entry is never picked up
+            tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+            for path in paths:
+                self.copy_function(path, os.path.join(tmp_dir, os.path.basename(path)))
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump(meta, f)
+
+            entry_dir = os.path.join(self.cache_dir, key)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+            print(f"Stored {len(paths)} artifacts in build cache entry {key[:12]}")
+        except OSError as e:
+            print(f"Couldn't store build cache entry: {e}")
+            return
+        self._evict(os.path.basename(paths[0]))
+
+    def _evict(self, name):
+        # Limit applies per artifact name, so apps sharing the cache don't evict each other
+        entries = [os.path.join(self.cache_dir, entry) for entry in os.listdir(self.cache_dir) if not entry.startswith(".")]
+        entries = [entry for entry in entries if os.path.isfile(os.path.join(entry, name))]
+        entries = sorted(entries, key=os.path.getmtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            print(f"Evicting build cache entry {os.path.basename(entry)[:12]}")
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def _load_index(self, index_path):
+        try:
+            with open(index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_json(self, path, data):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Couldn't write build cache index: {e}")
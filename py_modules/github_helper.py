@@ -1,17 +1,30 @@
-import certifi
+from .http_cache import HttpCache
+from .metrics import metrics
+from .msync import MSync
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
 import json
 import os
+import random
 import requests
-import ssl
-import urllib
+import time
 
-GITHUB_API_URL = "https://api.github.com"
+# Set by GitHub Actions (also on GitHub Enterprise), the uploads host is configurable for the same reason
+GITHUB_API_URL = os.getenv("GITHUB_API_URL") or "https://api.github.com"
+GITHUB_UPLOADS_URL = os.getenv("INPUT_UPLOADS_URL") or "https://uploads.github.com"
 
 TOKEN = os.getenv("GITHUB_TOKEN")  # You need to export this environment variable
 HEADERS = {
     "Authorization": f"Bearer {TOKEN}",
     "Accept": "application/vnd.github.v3+json",
 }
+MAX_RETRIES = 4
+# Longest wait for a rate limit reset before giving up, in seconds
+MAX_RATE_LIMIT_WAIT = 300
+# POST isn't idempotent: only retried when GitHub rejected it before doing anything (rate limit)
+IDEMPOTENT_METHODS = ["GET", "HEAD", "PUT", "DELETE"]
+UPLOAD_WORKERS = 4
 
 class GithubHelper:
     def __init__(self) -> None:
@@ -19,9 +32,23 @@ class GithubHelper:
         self.repo = os.getenv("GITHUB_REPOSITORY")
         self.env_path = os.getenv("GITHUB_ENV")
         self.out_path = os.getenv("GITHUB_OUTPUT")
+        self.summary_path = os.getenv("GITHUB_STEP_SUMMARY")
         self.action_path = os.getenv("GITHUB_ACTION_PATH")
         self.trigger = os.getenv("github.event_name")
         self.latest_url = f"{GITHUB_API_URL}/repos/{self.repo}/releases/latest"
+        # Always revalidated (ttl 0): 304 answers don't count against the rate limit
+        self.cache = HttpCache(ttl = int(os.getenv("GITHUB_CACHE_TTL", "0")))
+        # One keep-alive session for every call, shared by the threads of gh_release.py
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS if TOKEN else {"Accept": HEADERS["Accept"]})
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        self.default_branch_sha = None
+        self.upload_release = None
+        self.upload_executor = None
+        self.upload_futures = []
+        self.release_assets = {}
 
         if os.getenv("GITHUB_ACTIONS") == "true":
             print(f"GitHub run triggered by {self.trigger}")
@@ -52,25 +79,109 @@ class GithubHelper:
         else:
             print("Failed to locate $GITHUB_OUTPUT. Are you running this script inside GitHub Actions?")
 
+    def publish_metrics(self, metrics_path, title):
+        print(f"Writing metrics to '{metrics_path}'")
+        metrics.write_json(metrics_path)
+        self.set_github_env_variable("METRICS_PATH", metrics_path)
+        self.set_github_out_variable("metrics_path", metrics_path)
+        self.set_github_out_variable("metrics", json.dumps(metrics.to_dict(), separators=(",", ":")))
+        if self.summary_path:
+            with open(self.summary_path, "a") as f:
+                f.write(metrics.to_markdown(title))
+
+    def request(self, method, url, retries = MAX_RETRIES, **kwargs):
+        # Relative urls are resolved against the repository API
+        if not url.startswith("http"):
+            url = f"{GITHUB_API_URL}/repos/{self.repo}/{url}"
+
+        for attempt in range(retries + 1):
+            self.wait_rate_limit()
+            try:
+                response = self.session.request(method, url, timeout=30, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == retries or method not in IDEMPOTENT_METHODS:
+                    raise e
+                delay = self.get_backoff(attempt)
+                print(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            delay = self.get_retry_delay(method, response, attempt)
+            if delay is None or attempt == retries:
+                return response
+            print(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def request_json(self, method, url, **kwargs):
+        response = self.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def paginate(self, url, params = None):
+        # Follows the Link header, so repos with many releases or tags are fully listed
+        params = {"per_page": 100, **(params or {})}
+        while url:
+            response = self.request("GET", url, params=params)
+            response.raise_for_status()
+            yield from response.json()
+            url = response.links.get("next", {}).get("url")
+            # The next url already carries the query
+            params = None
+
+    def get_retry_delay(self, method, response, attempt):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is not None:
+            self.rate_limit_remaining = int(remaining)
+            self.rate_limit_reset = int(response.headers.get("X-RateLimit-Reset", "0"))
+            if self.rate_limit_remaining < 10:
+                print(f"GitHub API rate limit almost exhausted: {remaining} requests left")
+
+        if response.status_code in [403, 429]:
+            # Secondary rate limits send Retry-After, primary ones an exhausted X-RateLimit-Remaining
+            if response.headers.get("Retry-After"):
+                delay = int(response.headers["Retry-After"])
+            elif remaining == "0":
+                delay = max(self.rate_limit_reset - time.time(), 0) + 1
+            else:
+                return None
+            return delay if delay <= MAX_RATE_LIMIT_WAIT else None
+
+        if response.status_code >= 500 and method in IDEMPOTENT_METHODS:
+            return self.get_backoff(attempt)
+        return None
+
+    def get_backoff(self, attempt):
+        # Exponential with jitter, so concurrent calls don't retry in lockstep
+        return min(2 ** attempt, 30) * (0.5 + random.random() / 2)
+
+    def wait_rate_limit(self):
+        if self.rate_limit_remaining == 0 and self.rate_limit_reset:
+            delay = self.rate_limit_reset - time.time() + 1
+            if 0 < delay <= MAX_RATE_LIMIT_WAIT:
+                print(f"GitHub API rate limit exhausted, waiting {delay:.0f}s for the reset")
+                time.sleep(delay)
+                self.rate_limit_remaining = None
+
     def get_latest_version(self):
-        url = self.latest_url
-        response = urllib.request.urlopen(url, context=ssl.create_default_context(cafile=certifi.where()))
-        json_data = json.load(response)
+        with metrics.phase("github.get_latest_version"):
+            json_data = self.cache.get_json(self.latest_url, session = self.session)
 
         return json_data.get("tag_name")
 
     def check_update_required(self, new_version):
+        # Multi-app builds pass every version, any of them differing from the latest release needs an update
+        new_versions = new_version if isinstance(new_version, list) else [new_version]
         update = False
         try:
             vers = self.get_latest_version()
 
-            if vers and vers != new_version:
-                print(f"New available version {vers} -> {new_version}")
+            if vers and any(vers != version for version in new_versions):
+                print(f"New available version {vers} -> {', '.join(new_versions)}")
                 update = True
             else:
                 print("AppImage is up-to-date")
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
                 print(f"No previous releases found for {self.repo}")
                 update = True
             else:
@@ -80,67 +191,161 @@ class GithubHelper:
         self.set_github_out_variable("is_update", f"{update}".lower())
         return update
 
-    def delete_release(self, tag_name):
-        response = requests.get(f"{GITHUB_API_URL}/repos/{self.repo}/releases", headers=HEADERS)
+    def get_latest_release(self):
+        response = self.request("GET", "releases/latest")
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
-        releases = response.json()
+        return response.json()
+
+    def download_asset(self, asset, path):
+        # API url instead of browser_download_url so private repos work too
+        with metrics.phase("github.download_asset", asset["size"]):
+            with self.request("GET", asset["url"], headers={"Accept": "application/octet-stream"}, stream=True) as response:
+                response.raise_for_status()
+                with open(path, "wb") as f:
+                    for chunk in response.iter_content(MSync.stream_chunk_size):
+                        f.write(chunk)
+        print(f"Asset '{asset['name']}' downloaded ({MSync.format_bytes(asset['size'])})")
 
-        for release in releases:
+    def get_release(self, tag_name):
+        response = self.request("GET", f"releases/tags/{tag_name}")
+        if response.status_code != 404:
+            response.raise_for_status()
+            return response.json()
+        # Drafts aren't found by tag, look for them in the full list
+        for release in self.paginate("releases"):
             if release["tag_name"] == tag_name:
-                release_id = release["id"]
-                delete_url = f"{GITHUB_API_URL}/repos/{self.repo}/releases/{release_id}"
-                delete_response = requests.delete(delete_url, headers=HEADERS)
-                delete_response.raise_for_status()
-                print(f"Release '{tag_name}' deleted.")
+                return release
+        return None
+
+    def delete_release(self, tag_name):
+        with metrics.phase("github.delete_release"):
+            release = self.get_release(tag_name)
+            if release is None:
+                print(f"Release '{tag_name}' not found.")
                 return
 
+            self.request("DELETE", f"releases/{release['id']}").raise_for_status()
+            print(f"Release '{tag_name}' deleted.")
+
     def delete_tag(self, tag_name):
-        response = requests.get(f"{GITHUB_API_URL}/repos/{self.repo}/git/refs/tags", headers=HEADERS)
-        response.raise_for_status()
-        tags = response.json()
-
-        for tag in tags:
-            if tag["ref"] == f"refs/tags/{tag_name}":
-                delete_url = f"{GITHUB_API_URL}/repos/{self.repo}/git/refs/tags/{tag_name}"
-                delete_response = requests.delete(delete_url, headers=HEADERS)
-                delete_response.raise_for_status()
-                print(f"Tag '{tag_name}' deleted.")
+        with metrics.phase("github.delete_tag"):
+            response = self.request("DELETE", f"git/refs/tags/{tag_name}")
+            # GitHub answers 422 "Reference does not exist" for missing refs
+            if response.status_code in [404, 422]:
+                print(f"Tag '{tag_name}' not found.")
                 return
+            response.raise_for_status()
+            print(f"Tag '{tag_name}' deleted.")
 
     def create_tag(self, new_version):
         """Creates a new tag."""
-        payload = {
-            "ref": f"refs/tags/{new_version}",
-            "sha": self.get_default_branch_sha()
-        }
-        response = requests.post(f"{GITHUB_API_URL}/repos/{self.repo}/git/refs", headers=HEADERS, json=payload)
-        response.raise_for_status()
-        print(f"Tag '{new_version}' created.")
+        with metrics.phase("github.create_tag"):
+            payload = {
+                "ref": f"refs/tags/{new_version}",
+                "sha": self.get_default_branch_sha()
+            }
+            self.request_json("POST", "git/refs", json=payload)
+            print(f"Tag '{new_version}' created.")
 
     def get_default_branch_sha(self):
         """Gets the SHA of the default branch."""
-        response = requests.get(f"{GITHUB_API_URL}/repos/{self.repo}", headers=HEADERS)
-        response.raise_for_status()
-        repo_data = response.json()
-        default_branch = repo_data["default_branch"]
+        # Every tag of a run points to the same commit
+        if self.default_branch_sha is not None:
+            return self.default_branch_sha
 
-        branch_response = requests.get(f"{GITHUB_API_URL}/repos/{self.repo}/git/ref/heads/{default_branch}", headers=HEADERS)
-        branch_response.raise_for_status()
-        branch_data = branch_response.json()
-        return branch_data["object"]["sha"]
+        with metrics.phase("github.get_default_branch_sha"):
+            repo_data = self.request_json("GET", f"{GITHUB_API_URL}/repos/{self.repo}")
+            default_branch = repo_data["default_branch"]
+
+            branch_data = self.request_json("GET", f"git/ref/heads/{default_branch}")
+            self.default_branch_sha = branch_data["object"]["sha"]
+            return self.default_branch_sha
 
     def create_release(self, new_version):
         """Creates a new release."""
-        payload = {
-            "tag_name": new_version,
-            "name": new_version,
-            "body": f"Version {new_version} generated automatically.",
-            "draft": False,
-            "prerelease": False,
-        }
-        response = requests.post(f"{GITHUB_API_URL}/repos/{self.repo}/releases", headers=HEADERS, json=payload)
-        response.raise_for_status()
-        print(f"Release '{new_version}' created.")
+        with metrics.phase("github.create_release"):
+            payload = {
+                "tag_name": new_version,
+                "name": new_version,
+                "body": f"Version {new_version} generated automatically.",
+                "draft": False,
+                "prerelease": False,
+            }
+            release = self.request_json("POST", "releases", json=payload)
+            print(f"Release '{new_version}' created.")
+            return release
+
+    def get_or_create_release(self, tag_name):
+        return self.get_release(tag_name) or self.create_release(tag_name)
+
+    def start_uploads(self, tag_name):
+        # Assets are uploaded in the background as soon as they are ready, while the rest is still being generated
+        self.upload_release = self.get_or_create_release(tag_name)
+        self.release_assets = {asset["name"]: asset for asset in self.paginate(f"releases/{self.upload_release['id']}/assets")}
+        self.upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        self.upload_futures = []
+        print(f"Uploading assets to release '{tag_name}'")
+
+    def upload_asset(self, path, name = None):
+        if self.upload_executor is None:
+            return
+        name = name or os.path.basename(path)
+        self.upload_futures.append(self.upload_executor.submit(self._upload_asset, path, name))
+
+    def wait_uploads(self):
+        if self.upload_executor is None:
+            return
+        errors = []
+        for future in self.upload_futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error uploading asset: {e}")
+                errors.append(e)
+        self.upload_executor.shutdown()
+        self.upload_executor = None
+        if errors:
+            raise errors[0]
+
+    def _upload_asset(self, path, name):
+        url = f"{GITHUB_UPLOADS_URL}/repos/{self.repo}/releases/{self.upload_release['id']}/assets"
+        size = os.path.getsize(path)
+        with metrics.phase("github.upload_asset", size):
+            for attempt in range(MAX_RETRIES + 1):
+                # Replaces the asset of a previous run, or what a failed attempt left behind
+                self.delete_asset(name, refresh = attempt > 0)
+                try:
+                    # Streamed from disk, the file object is reopened on every attempt
+                    with open(path, "rb") as f:
+                        response = self.request("POST", url, retries = 0, params={"name": name}, data=f,
+                                                headers={"Content-Type": "application/octet-stream"})
+                    # 422 is an asset with the same name, left by an upload that failed partway
+                    if response.status_code < 500 and response.status_code != 422:
+                        response.raise_for_status()
+                        print(f"Asset '{name}' uploaded ({MSync.format_bytes(size)})")
+                        return
+                    error = f"status {response.status_code}"
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+
+                if attempt == MAX_RETRIES:
+                    raise RuntimeError(f"Upload of '{name}' failed: {error}")
+                delay = self.get_backoff(attempt)
+                print(f"Upload of '{name}' failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def delete_asset(self, name, refresh = False):
+        if refresh:
+            self.release_assets = {asset["name"]: asset for asset in self.paginate(f"releases/{self.upload_release['id']}/assets")}
+        asset = self.release_assets.pop(name, None)
+        if asset is None:
+            return
+        response = self.request("DELETE", f"releases/assets/{asset['id']}")
+        if response.status_code != 404:
+            response.raise_for_status()
+        print(f"Asset '{name}' deleted.")
 
     def increment_version(self, version):
         """Increments the patch version."""
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import requests
+import tempfile
+import time
+
+class HttpCache:
+    def __init__(self, cache_dir = None, ttl = None) -> None:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "appimage-creator", "http")
+        if ttl is None:
+            ttl = int(os.getenv("APPIMAGE_HTTP_CACHE_TTL", "300"))
+        self.cache_dir = cache_dir
+        # Seconds during which a cached response is used without asking the server at all
+        self.ttl = ttl
+
+    def get(self, url, headers = None, session = None):
+        meta_path, body_path = self._paths(url)
+        meta = self._load_meta(meta_path, body_path)
+
+        if meta is not None and time.time() - meta["fetched_at"] < self.ttl:
+            print(f"Using cached response for {url}")
+            with open(body_path, "rb") as f:
+                return f.read()
+
+        request_headers = dict(headers or {})
+        if meta is not None:
+            if meta.get("etag"):
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                request_headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = (session or requests).get(url, headers=request_headers)
+        if response.status_code == 304 and meta is not None:
+            print(f"Cached response for {url} is still valid")
+            meta["fetched_at"] = time.time()
+            self._write(meta_path, json.dumps(meta).encode())
+            with open(body_path, "rb") as f:
+                return f.read()
+
+        response.raise_for_status()
+        content = response.content
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+        self._write(body_path, content)
+        self._write(meta_path, json.dumps(meta).encode())
+        return content
+
+    def get_json(self, url, headers = None, session = None):
+        return json.loads(self.get(url, headers, session))
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json"), os.path.join(self.cache_dir, f"{key}.body")
+
+    def _load_meta(self, meta_path, body_path):
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            return meta if os.path.isfile(body_path) else None
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, content):
+        # Write and rename so concurrent readers never see a partial entry
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Couldn't write HTTP cache entry '{path}': {e}")
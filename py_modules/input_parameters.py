@@ -12,17 +12,22 @@ class InputParameters:
     entrypoint: str
     icon: str
     desktop: str
+    compression: str
+    exclude: list
     
-    def __init__(self, name, version, entrypoint, icon, desktop):
+    def __init__(self, name, version, entrypoint, icon, desktop, compression = None, exclude = []):
         self.name = name
+        self.compression = compression
+        self.exclude = exclude
         self.entrypoint = os.path.abspath(entrypoint)
         self.icon = os.path.abspath(icon)
         self.desktop = os.path.abspath(desktop)
         self.version = version
     
     @staticmethod
-    def from_desktop_file():
-        desktop_file = InputParameters.find_desktop_file()
+    def from_desktop_file(desktop_file = None, aux_name = "aux.desktop"):
+        if desktop_file is None:
+            desktop_file = InputParameters.find_desktop_file()
 
         print("Loading desktop file data")
 
@@ -32,6 +37,8 @@ class InputParameters:
         entrypoint = desktop.data["AppImage Creator"]["Entrypoint"]
         icon = desktop.data["AppImage Creator"]["Icon"]
         versioncmd = desktop.data["AppImage Creator"]["Version-Cmd"]
+        compression = desktop.data["AppImage Creator"].get("Compression")
+        exclude = [pattern for pattern in desktop.data["AppImage Creator"].get("Exclude", "").split(";") if pattern]
         print(f"Getting version by running: {versioncmd}")
         result = subprocess.run(versioncmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
@@ -54,18 +61,37 @@ class InputParameters:
                     new_desktop_section_data[key] = value
                 new_desktop_data[section] = new_desktop_section_data            
 
-        desktop_path = os.path.abspath("aux.desktop")
+        desktop_path = os.path.abspath(aux_name)
         desktop.data = new_desktop_data
         desktop.persist(desktop_path)
 
-        return InputParameters(name, version, entrypoint, icon, desktop_path)
+        return InputParameters(name, version, entrypoint, icon, desktop_path, compression, exclude)
     
     @staticmethod
     def find_desktop_file():
         current_directory = os.getcwd()
         print(f"Looking for .desktop file in '{current_directory}'")
         for file_name in os.listdir(current_directory):
-            if file_name.endswith('.desktop') and file_name != "aux.desktop" and os.path.isfile(file_name):
+            if file_name.endswith('.desktop') and not InputParameters.is_aux_file(file_name) and os.path.isfile(file_name):
                 print(f"Found '{os.path.join(current_directory, file_name)}'")
                 return file_name
-        raise FileNotFoundError("Couldn't find .desktop file")
\ No newline at end of file
+        raise FileNotFoundError("Couldn't find .desktop file")
+
+    @staticmethod
+    def find_desktop_files():
+        current_directory = os.getcwd()
+        print(f"Looking for .desktop files with an [AppImage Creator] section in '{current_directory}'")
+        desktop_files = []
+        for file_name in sorted(os.listdir(current_directory)):
+            if file_name.endswith('.desktop') and not InputParameters.is_aux_file(file_name) and os.path.isfile(file_name):
+                if "AppImage Creator" in DesktopParser(file_name).data:
+                    print(f"Found '{os.path.join(current_directory, file_name)}'")
+                    desktop_files.append(file_name)
+        if not desktop_files:
+            raise FileNotFoundError("Couldn't find .desktop files with an [AppImage Creator] section")
+        return desktop_files
+
+    @staticmethod
+    def is_aux_file(file_name):
+        # Working copies written by from_desktop_file
+        return file_name == "aux.desktop" or (file_name.startswith("aux-") and file_name.endswith(".desktop"))
\ No newline at end of file
@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+
+import json
+import os
+import time
+
+class Metrics:
+    def __init__(self) -> None:
+        self.started_at = time.time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, size = None):
+        # The yielded record can be completed inside the block, e.g. when the size is known afterwards
+        record = {"name": name, "start": time.time() - self.started_at, "bytes": size}
+        t0 = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record["failed"] = True
+            raise
+        finally:
+            record["seconds"] = time.perf_counter() - t0
+            if record["bytes"] and record["seconds"] > 0:
+                record["bytes_per_second"] = record["bytes"] / record["seconds"]
+            self.phases.append(record)
+
+    def reset(self):
+        self.started_at = time.time()
+        self.phases = []
+
+    def add_phases(self, phases, prefix):
+        # Phases recorded by another process (multi-app builds), start is kept relative to that process
+        for record in phases:
+            self.phases.append({**record, "name": f"{prefix}/{record['name']}"})
+
+    def to_dict(self):
+        return {
+            "started_at": self.started_at,
+            "total_seconds": time.time() - self.started_at,
+            "phases": sorted(self.phases, key=lambda record: record["start"]),
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def append_json(self, path, **extra):
+        # One line per run, so a local history can be kept in a single file
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps({**extra, **self.to_dict()}) + "\n")
+
+    def to_markdown(self, title):
+        from .msync import MSync
+
+        data = self.to_dict()
+        lines = [f"### {title}", "", f"Total: {data['total_seconds']:.1f}s", "",
+                 "| Phase | Time | Size | Throughput |", "| --- | ---: | ---: | ---: |"]
+        for record in data["phases"]:
+            size = MSync.format_bytes(record["bytes"]) if record["bytes"] else "-"
+            speed = f"{MSync.format_bytes(record['bytes_per_second'])}/s" if "bytes_per_second" in record else "-"
+            name = record["name"] + (" (failed)" if record.get("failed") else "")
+            lines.append(f"| {name} | {record['seconds']:.2f}s | {size} | {speed} |")
+        return "\n".join(lines) + "\n"
+
+# Shared by every module of a run
+metrics = Metrics()
@@ -0,0 +1,252 @@
+from .metrics import metrics
+from .msync import MSync
+
+import contextlib
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+
+class MSDelta:
+    magic = b"MSDELTA\0"
+    version = 1
+    _header = struct.Struct("<8sBB")
+    _body = struct.Struct("<QQI")
+    _op = struct.Struct("<BQQ")
+    OP_COPY = 0
+    OP_ADD = 1
+
+    # Base file is indexed in aligned windows of this size, target windows are matched at any offset
+    window_size = 2 * 1024
+    # Shorter runs continuing the previous copy aren't worth an instruction
+    min_match = 32
+    # Past this share of new data the delta isn't worth it: every literal byte is a step of the
+    # pure Python scan (about 1 MB/s), so this also bounds the time spent on unrelated files
+    max_literal_ratio = 0.1
+    # Wall-clock budget of the scan, the build goes on without a delta after it
+    max_seconds = 60
+    _compare_size = 64 * 1024
+    _check_interval = 64 * 1024
+
+    def __init__(self, base_version, base_size, base_hash, target_size, target_hash, ops, file_hash = MSync.default_file_hash, literals = None) -> None:
+        self.base_version = base_version
+        self.base_size = base_size
+        self.base_hash = base_hash
+        self.target_size = target_size
+        self.target_hash = target_hash
+        # (OP_COPY, base offset, length) or (OP_ADD, literals offset, length)
+        self.ops = ops
+        self.file_hash = file_hash
+        # Data of the OP_ADD instructions: a bytes-like object, or the path of the file it's read from
+        # (the target, for deltas being created)
+        self.literals = literals
+
+    @staticmethod
+    def get_asset_name(name, base_version):
+        # The client looks the delta up by its own (installed) version
+        file_name = re.sub(r"[^a-zA-Z0-9]", "-", name)
+        return f"{file_name}.AppImage.{re.sub(r'[^a-zA-Z0-9.]', '-', base_version)}.msdelta"
+
+    @staticmethod
+    def create(base_path, target_path, base_version, file_hash = MSync.default_file_hash):
+        window = MSDelta.window_size
+        base_size = MSync.get_file_size(base_path)
+        target_size = MSync.get_file_size(target_path)
+        if base_size < window or target_size < window:
+            return None
+
+        with metrics.phase("msdelta.create", target_size), \
+             open(base_path, "rb") as base_file, mmap.mmap(base_file.fileno(), 0, access=mmap.ACCESS_READ) as base, \
+             open(target_path, "rb") as target_file, mmap.mmap(target_file.fileno(), 0, access=mmap.ACCESS_READ) as target:
+            index = {}
+            for offset in range(0, base_size - window + 1, window):
+                index.setdefault(zlib.adler32(base[offset:offset + window]), offset)
+
+            ops = []
+            deadline = time.monotonic() + MSDelta.max_seconds
+            check = MSDelta._check_interval
+            literal_budget = int(target_size * MSDelta.max_literal_ratio)
+            literal_size = 0
+            literal_start = 0
+            position = 0
+            expected = None
+            a = None
+            while position + window <= target_size:
+                if expected is not None:
+                    # Most of the time the data right after a copy keeps matching the base
+                    length = MSDelta._match_forward(base, expected, target, position)
+                    if length >= MSDelta.min_match:
+                        literal_size += MSDelta._add_literal(ops, literal_start, position)
+                        ops.append((MSDelta.OP_COPY, expected, length))
+                        position += length
+                        expected += length
+                        literal_start = position
+                        a = None
+                        continue
+                    expected = None
+
+                if a is None:
+                    a, b = MSync._weak_sums(target[position:position + window])
+                offset = index.get(a | (b << 16))
+                if offset is not None and base[offset:offset + window] == target[position:position + window]:
+                    # The match may start before the window, inside the pending literal
+                    back = MSDelta._match_backward(base, offset, target, position, min(offset, position - literal_start))
+                    length = back + MSDelta._match_forward(base, offset, target, position)
+                    literal_size += MSDelta._add_literal(ops, literal_start, position - back)
+                    ops.append((MSDelta.OP_COPY, offset - back, length))
+                    position = position - back + length
+                    expected = offset - back + length
+                    literal_start = position
+                    a = None
+                    continue
+
+                if literal_size + position - literal_start > literal_budget:
+                    print(f"Files too different for a delta (over {MSync.format_bytes(literal_budget)} of new data)")
+                    return None
+                if position >= check:
+                    if time.monotonic() > deadline:
+                        print(f"Delta not finished after {MSDelta.max_seconds}s, skipping it")
+                        return None
+                    check = position + MSDelta._check_interval
+                if position + window >= target_size:
+                    break
+                # Rolling Adler-32, same as MSync._scan_weak
+                out_byte = target[position]
+                a = (a - out_byte + target[position + window]) % 65521
+                b = (b - window * out_byte + a - 1) % 65521
+                position += 1
+
+            literal_size += MSDelta._add_literal(ops, literal_start, target_size)
+
+        base_hash = MSync.calculate_file_hash(base_path, file_hash)
+        target_hash = MSync.calculate_file_hash(target_path, file_hash)
+        print(f"Delta: {len(ops)} instructions, {MSync.format_bytes(literal_size)} of new data")
+        # Literals stay in the target file until the delta is written
+        return MSDelta(base_version, base_size, base_hash, target_size, target_hash, ops, file_hash, target_path)
+
+    @staticmethod
+    def _add_literal(ops, start, end):
+        if end > start:
+            ops.append((MSDelta.OP_ADD, start, end - start))
+        return end - start
+
+    @staticmethod
+    def _match_forward(base, base_offset, target, target_offset):
+        # Length of the common prefix, compared in slices so the work stays in C
+        limit = min(len(base) - base_offset, len(target) - target_offset)
+        length = 0
+        step = MSDelta._compare_size
+        while length + step <= limit and base[base_offset + length:base_offset + length + step] == target[target_offset + length:target_offset + length + step]:
+            length += step
+        low, high = length, min(length + step, limit)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if base[base_offset + length:base_offset + middle] == target[target_offset + length:target_offset + middle]:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    @staticmethod
+    def _match_backward(base, base_offset, target, target_offset, limit):
+        # Length of the common suffix before both offsets, a matching suffix implies every shorter one does
+        low, high = 0, limit
+        while low < high:
+            middle = (low + high + 1) // 2
+            if base[base_offset - middle:base_offset] == target[target_offset - middle:target_offset]:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def to_file(self, file_path):
+        # Literals are streamed from their source through the compressor, never held all at once
+        compressor = zlib.compressobj(9)
+        with open(file_path, "wb") as f, self._open_literals() as literals:
+            f.write(self._header.pack(MSDelta.magic, MSDelta.version, 0))
+            for piece in self._iter_body(literals):
+                f.write(compressor.compress(piece))
+            f.write(compressor.flush())
+
+    def to_bytes(self):
+        with self._open_literals() as literals:
+            return self._header.pack(MSDelta.magic, MSDelta.version, 0) + zlib.compress(b"".join(self._iter_body(literals)), 9)
+
+    def _iter_body(self, literals):
+        yield self._body.pack(self.base_size, self.target_size, len(self.ops))
+        for value in [self.file_hash.encode(), bytes.fromhex(self.base_hash), bytes.fromhex(self.target_hash), self.base_version.encode()]:
+            yield bytes([len(value)]) + value
+        for kind, offset, length in self.ops:
+            if kind == MSDelta.OP_COPY:
+                yield self._op.pack(kind, offset, length)
+                continue
+            yield self._op.pack(MSDelta.OP_ADD, 0, length)
+            for start in range(offset, offset + length, MSDelta._compare_size):
+                yield literals[start:min(start + MSDelta._compare_size, offset + length)]
+
+    @contextlib.contextmanager
+    def _open_literals(self):
+        if not isinstance(self.literals, str):
+            yield self.literals
+            return
+        with open(self.literals, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as literals:
+                yield literals
+
+    @staticmethod
+    def from_bytes(content):
+        magic, version, _ = MSDelta._header.unpack_from(content)
+        if magic != MSDelta.magic:
+            raise Exception("Not an MSDelta file")
+        if version != MSDelta.version:
+            raise Exception(f"Unsupported MSDelta version {version}")
+
+        body = memoryview(zlib.decompress(memoryview(content)[MSDelta._header.size:]))
+        base_size, target_size, count = MSDelta._body.unpack_from(body)
+        position = MSDelta._body.size
+        values = []
+        for _ in range(4):
+            values.append(bytes(body[position + 1:position + 1 + body[position]]))
+            position += 1 + body[position]
+        file_hash, base_hash, target_hash, base_version = values
+
+        ops = []
+        for _ in range(count):
+            kind, offset, length = MSDelta._op.unpack_from(body, position)
+            position += MSDelta._op.size
+            if kind == MSDelta.OP_COPY:
+                ops.append((kind, offset, length))
+            else:
+                ops.append((kind, position, length))
+                position += length
+        return MSDelta(base_version.decode(), base_size, base_hash.hex(), target_size, target_hash.hex(), ops, file_hash.decode(), body)
+
+    def apply(self, base_path, output_path):
+        if MSync.get_file_size(base_path) != self.base_size:
+            raise Exception(f"'{base_path}' is not the base of this delta")
+
+        # Own working copy, a resumable MSync patch may be using the .msync-part one
+        tmp_path = os.path.splitext(MSync._working_paths(output_path)[0])[0] + ".msdelta-part"
+        try:
+            with metrics.phase("msdelta.apply", self.target_size):
+                with open(base_path, "rb") as src, open(tmp_path, "wb") as dst, self._open_literals() as literals:
+                    position = 0
+                    for kind, offset, length in self.ops:
+                        if kind == MSDelta.OP_COPY:
+                            MSync.copy_range(src.fileno(), dst.fileno(), offset, position, length)
+                        else:
+                            os.pwrite(dst.fileno(), literals[offset:offset + length], position)
+                        position += length
+
+            with metrics.phase("msdelta.verify", self.target_size):
+                hash = MSync.calculate_file_hash(tmp_path, self.file_hash)
+            if hash != self.target_hash:
+                raise Exception("Checksum doesn't match")
+
+            os.chmod(tmp_path, os.stat(base_path).st_mode)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
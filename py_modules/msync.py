@@ -1,38 +1,158 @@
 import time
+import array
+import bisect
+import fcntl
 import hashlib
+import io
 import os
 import json
 import math
-import shutil
-import tempfile
+import mmap
+import re
 import requests
+import struct
+import sys
+import threading
+import zlib
+from collections import deque
 from urllib.parse import urlsplit
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from .metrics import metrics
+
 class MSync:
     block_size = 512 * 1024
 
-    def __init__(self, name, size, hash, blocks, url = None) -> None:
+    # Binary manifest: header (magic, format version, flags, reserved) followed by an optionally
+    # zlib-compressed body (size, block count, block size, digest size, file hash size, name length)
+    binary_magic = b"MSYNCBIN"
+    binary_version = 1
+    _binary_header = struct.Struct("<8sBBH")
+    _binary_body = struct.Struct("<QIIBBH")
+    FLAG_COMPRESSED = 1
+    FLAG_WEAK = 2
+    FLAG_CHUNKS = 4
+    FLAG_ALGORITHMS = 8
+
+    # Digests that can be used for blocks and for the whole file, recorded in the manifest
+    hash_algorithms = {
+        "md5": lambda: hashlib.md5(),
+        "sha1": lambda: hashlib.sha1(),
+        "sha256": lambda: hashlib.sha256(),
+        "sha512": lambda: hashlib.sha512(),
+        "blake2b": lambda: hashlib.blake2b(),
+        "blake2b-128": lambda: hashlib.blake2b(digest_size=16),
+        "blake2b-144": lambda: hashlib.blake2b(digest_size=18),
+        "blake2b-256": lambda: hashlib.blake2b(digest_size=32),
+        "blake2s-128": lambda: hashlib.blake2s(digest_size=16),
+    }
+    default_block_hash = "md5"
+    default_file_hash = "sha256"
+    # Read size for whole-file digests when hashlib.file_digest is not available
+    file_buffer_size = 1024 * 1024
+
+    # Content-defined chunking (manifest v2, experimental), FastCDC-style: a chunk ends where a hash
+    # of the last _cdc_window bytes has the mask bits clear, with a stricter mask before cdc_avg_size
+    # and a looser one after it. Only positions holding _cdc_anchor (one in 256 on compressed data)
+    # are hashed, so the scan runs in C. Data without the anchor byte is cut at cdc_max_size
+    cdc_min_size = 16 * 1024
+    cdc_avg_size = 64 * 1024
+    cdc_max_size = 256 * 1024
+    _cdc_window = 48
+    _cdc_anchor = b"\x8f"
+    _cdc_mask_small = (1 << 9) - 1
+    _cdc_mask_large = (1 << 6) - 1
+
+    # Blocks being hashed at the same time while scanning a file, bounds memory usage
+    max_in_flight = 4 * (os.cpu_count() or 1)
+    # Size of the pieces streamed from a range response to disk
+    stream_chunk_size = 64 * 1024
+
+    # Download planning: unchanged gaps up to request_cost_blocks blocks (of the manifest's layout)
+    # are downloaded again rather than split into another range, and up to max_ranges_per_request
+    # ranges (max_request_size bytes) are sent in a single multi-range request
+    request_cost_blocks = 1
+    max_ranges_per_request = 32
+    max_request_size = 8 * 1024 * 1024
+    # Times the blocks failing verification are downloaded again before giving up
+    max_block_retries = 3
+    # The rolling search for moved blocks (a few MB/s) gives up after scanning max_scan_miss bytes
+    # without a match, or once it has taken longer than downloading the blocks at scan_bandwidth
+    max_scan_miss = 16 * 1024 * 1024
+    scan_bandwidth = 4 * 1024 * 1024
+    _scan_check_interval = 64 * 1024
+
+    def __init__(self, name, size, hash, blocks, url = None, chunks = None, weak_blocks = None, block_hash = default_block_hash, file_hash = default_file_hash) -> None:
         self.name = name
         self.size = size
         self.hash = hash
         self.blocks = blocks
         self.url = url
+        # (offset, length) of every block for content-defined manifests, None for fixed-size ones
+        if chunks is not None and not isinstance(chunks, ChunkTable):
+            chunks = ChunkTable([length for _, length in chunks])
+        self.chunks = chunks
+        # Rolling checksums of fixed-size blocks, optional (older manifests don't have them)
+        self.weak_blocks = weak_blocks
+        self.block_hash = block_hash
+        self.file_hash = file_hash
+        self.version = 1 if chunks is None else 2
     
-    def to_file(self, file_path):
+    def to_file(self, file_path, binary = False, compress = False):
+        if binary:
+            with open(file_path, 'wb') as f:
+                f.write(self.to_bytes(compress))
+            return
+
         data = {}
         data["name"] = self.name    
         data["size"] = self.size
         data["hash"] = self.hash
-        data["blocks"] = self.blocks
+        data["block_hash"] = self.block_hash
+        data["file_hash"] = self.file_hash
+        if self.chunks is None:
+            data["blocks"] = self.blocks
+            if self.weak_blocks is not None:
+                data["weak"] = self.weak_blocks
+        else:
+            data["version"] = 2
+            data["chunks"] = [[offset, length, block] for (offset, length), block in zip(self.chunks, self.blocks)]
 
         with open(file_path, 'w') as f:
-            json.dump(data, f) 
+            json.dump(data, f, default=list) 
+
+    def to_bytes(self, compress = False):
+        flags = 0
+        digests = b"".join(bytes.fromhex(block) for block in self.blocks)
+        digest_size = len(digests) // len(self.blocks) if self.blocks else 0
+        file_hash = bytes.fromhex(self.hash)
+        name = self.name.encode()
+
+        body = [self._binary_body.pack(self.size, len(self.blocks), MSync.block_size, digest_size, len(file_hash), len(name)), name]
+        if (self.block_hash, self.file_hash) != (MSync.default_block_hash, MSync.default_file_hash):
+            flags |= MSync.FLAG_ALGORITHMS
+            for algorithm in [self.block_hash, self.file_hash]:
+                body.append(bytes([len(algorithm)]) + algorithm.encode())
+        body += [file_hash, digests]
+        if self.weak_blocks is not None:
+            flags |= MSync.FLAG_WEAK
+            body.append(MSync._pack_uint32(self.weak_blocks))
+        if self.chunks is not None:
+            flags |= MSync.FLAG_CHUNKS
+            body.append(MSync._pack_uint32([length for _, length in self.chunks]))
+
+        body = b"".join(body)
+        if compress:
+            # Digests barely compress, this mostly pays off for weak sums and chunk lengths
+            flags |= MSync.FLAG_COMPRESSED
+            body = zlib.compress(body, 9)
+
+        return self._binary_header.pack(MSync.binary_magic, MSync.binary_version, flags, 0) + body
 
-    def patch(self, file_path, binary_url = None, overwrite = True):
+    def patch(self, file_path, binary_url = None, overwrite = True, seeds = None, output_path = None):
         t0=time.time()
-        tmp_path = None
         session = requests.Session()
+        journal = None
         url = binary_url
         if url is None:
             parsed_url = urlsplit(self.url)
@@ -40,164 +160,710 @@ class MSync:
             url = f"{parsed_url.scheme}://{parsed_url.netloc}{base_path}/{self.name}"
         
         try:
-            file_hash = MSync.calculate_file_hash(file_path)
+            with metrics.phase("msync.check", MSync.get_file_size(file_path)):
+                file_hash = MSync.calculate_file_hash(file_path, self.file_hash)
             if file_hash == self.hash:
                 print(f"No changes detected for file '{file_path}'")
                 return
             
             print(f"Patching changes for '{file_path}'")
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                print(f"Copying to working copy '{tmp_file.name}'")
-                shutil.copy2(file_path, tmp_file.name)
-                tmp_path = tmp_file.name
-
-            with open(tmp_path, 'rb+') as file:
-                print(f"Adjusting file size to {MSync.format_bytes(self.size)}")
-                current_size = MSync.get_file_size(tmp_path)
-                if current_size < self.size:
-                    file.write(b'\0' * (self.size - current_size))
-                    print(f"    File padded with {MSync.format_bytes(self.size - current_size)}")
-                elif current_size > self.size:
-                    file.truncate(self.size)
-                    print(f"    File truncated by {MSync.format_bytes(current_size - self.size)}")
-
-            print("Checking blocks to patch")
-            blocks = MSync.get_file_blocks(tmp_path)
-            changed_blocks = []
-            for i in range(len(blocks)):
-                if blocks[i] != self.blocks[i]:
-                    changed_blocks.append(i)
-
-            grouped_blocks = MSync._group_blocks(self.size, changed_blocks)
+            with metrics.phase("msync.prepare"):
+                # The result replaces the file itself unless it has to be staged somewhere else
+                target_path = file_path if output_path is None else output_path
+                tmp_path, journal_path = MSync._working_paths(target_path)
+                journal = PatchJournal(journal_path, self.hash, self.size, "fixed" if self.chunks is None else "cdc", len(self.blocks))
+                done_blocks = journal.open()
+                if done_blocks and os.path.isfile(tmp_path) and MSync.get_file_size(tmp_path) == self.size:
+                    print(f"Resuming working copy '{tmp_path}' ({len(done_blocks)} blocks already verified)")
+                else:
+                    done_blocks = set()
+                    journal.reset()
+                    if self.chunks is None:
+                        print(f"Cloning to working copy '{tmp_path}'")
+                        MSync.clone_file(file_path, tmp_path)
+                    else:
+                        print(f"Using working copy '{tmp_path}'")
+                        open(tmp_path, 'wb').close()
+
+                    print(f"Adjusting file size to {MSync.format_bytes(self.size)}")
+                    os.truncate(tmp_path, self.size)
+
+                seed_files = MSync.find_seeds(seeds or [], [file_path, tmp_path])
+                if self.chunks is None:
+                    changed_blocks = self._prepare_fixed(file_path, tmp_path)
+                    if changed_blocks and seed_files:
+                        changed_blocks = self._reuse_seed_blocks(seed_files, tmp_path, changed_blocks)
+                else:
+                    changed_blocks = self._reuse_seed_blocks([file_path] + seed_files, tmp_path, range(len(self.blocks)))
+                changed_blocks = [i for i in changed_blocks if i not in done_blocks]
+
+            requests_plan = MSync._plan_requests([self._block_range(i) for i in changed_blocks], self._request_cost())
             total_size = 0
-            for start, end in grouped_blocks:
-                total_size += (end - start)
+            for request_ranges in requests_plan:
+                for start, end in request_ranges:
+                    total_size += (end - start)
 
             print(f"Need to patch {len(changed_blocks)}/{len(self.blocks)} blocks.")
-            print(f"Estimated download size: {MSync.format_bytes(total_size)}/{MSync.format_bytes(self.size)} ({math.floor(10000 * (total_size) / self.size) / 100}%)")
+            print(f"Estimated download size: {MSync.format_bytes(total_size)}/{MSync.format_bytes(self.size)} ({math.floor(10000 * (total_size) / self.size) / 100}%) in {len(requests_plan)} requests")
 
-            with ThreadPoolExecutor() as executor:
-                futures = []
-                for start, end in grouped_blocks:
-                    futures.append(executor.submit(MSync.download_chunk, session, start, end, url))
+            progress = DownloadProgress(total_size)
+            server = {"multi_range": True}
+            with open(tmp_path, 'r+b') as f:
+                request_blocks = self._assign_blocks(requests_plan)
+                downloaded = {i for blocks in request_blocks for i in blocks}
+                verifier = PatchVerifier(self, f.fileno(), [i for i in range(len(self.blocks)) if i not in downloaded])
+                with metrics.phase("msync.download", total_size), ThreadPoolExecutor() as executor:
+                    failed = self._download_blocks(executor, session, requests_plan, request_blocks, url, f.fileno(), progress, server, journal, verifier)
+                    for attempt in range(1, MSync.max_block_retries + 1):
+                        if not failed:
+                            break
+                        # Exact ranges this time, so blocks already verified are never written again
+                        requests_plan = MSync._plan_requests([self._block_range(i) for i in failed], max_gap = 0)
+                        retry_size = sum(end - start for request_ranges in requests_plan for start, end in request_ranges)
+                        print(f"Retrying {len(failed)} blocks that failed verification ({MSync.format_bytes(retry_size)}, attempt {attempt}/{MSync.max_block_retries})")
+                        progress.add_total(retry_size)
+                        failed = self._download_blocks(executor, session, requests_plan, self._assign_blocks(requests_plan), url, f.fileno(), progress, server, journal, verifier)
+                if failed:
+                    # Verified blocks stay in the journal, the next run only downloads the rest
+                    raise Exception(f"{len(failed)} blocks still don't match after {MSync.max_block_retries} retries")
 
-                with open(tmp_path, 'r+b') as f:
-                    for future in as_completed(futures):
-                        data, start, end = future.result()
-                        f.seek(start)
-                        f.write(data)
-
-            print("Checking integrity after update")
-            hash = MSync.calculate_file_hash(tmp_path)
+                print("Checking integrity after update")
+                with metrics.phase("msync.verify", self.size):
+                    # Only reads what the hash didn't reach while downloading
+                    hash = verifier.finish()
             if hash == self.hash:
                 print("    Integrity test passed successfully")
-                print("Setting permissions")
                 
                 if overwrite:
-                    permissions = os.stat(file_path).st_mode
-                    os.remove(file_path)
-                    shutil.copy2(tmp_path, file_path)
-                    os.chmod(file_path, permissions)                
+                    print("Setting permissions")
+                    os.chmod(tmp_path, os.stat(file_path).st_mode)
+                    os.replace(tmp_path, target_path)
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                journal.close(remove = True)
 
                 elapsed_time = math.floor(1000*(time.time() - t0))/1000
                 speed = total_size/elapsed_time
                 print(f"MSync patch finished after {elapsed_time} ({MSync.format_bytes(speed)}/s)")
             else:
+                os.remove(tmp_path)
+                journal.close(remove = True)
                 raise Exception("Checksum doesn't match")
         finally:
-            if tmp_path is not None:
-                os.remove(tmp_path)
+            if journal is not None:
+                journal.close()
             session.close()
 
+    def _block_range(self, i):
+        if self.chunks is None:
+            start = i * MSync.block_size
+            return start, min(start + MSync.block_size, self.size)
+        offset, length = self.chunks[i]
+        return offset, offset + length
+
+    def _request_cost(self):
+        # Gaps are made of whole blocks, a limit under one block would never merge anything
+        return MSync.request_cost_blocks * (MSync.block_size if self.chunks is None else MSync.cdc_avg_size)
+
+    def _block_index(self, offset):
+        if self.chunks is None:
+            return offset // MSync.block_size
+        return self.chunks.find(offset)
+
+    def _assign_blocks(self, requests_plan):
+        # Every block written by each request, merged gaps included, so all of them are verified once it finishes
+        request_blocks = []
+        for request_ranges in requests_plan:
+            blocks = []
+            for start, end in request_ranges:
+                i = self._block_index(start)
+                while i < len(self.blocks) and self._block_range(i)[1] <= end:
+                    blocks.append(i)
+                    i += 1
+            request_blocks.append(blocks)
+        return request_blocks
+
+    def _download_blocks(self, executor, session, requests_plan, request_blocks, url, fd, progress, server, journal, verifier):
+        # Returns the blocks that have to be downloaded again
+        futures = []
+        for request_ranges, blocks in zip(requests_plan, request_blocks):
+            futures.append(executor.submit(self._download_request, session, request_ranges, blocks, url, fd, progress, server, journal, verifier))
+
+        failed = []
+        for future in as_completed(futures):
+            failed.extend(future.result())
+        return sorted(failed)
+
+    def _download_request(self, session, request_ranges, blocks, url, fd, progress, server, journal, verifier):
+        receiver = BlockReceiver(self, fd, blocks, verifier, journal)
+        try:
+            MSync.download_ranges(session, request_ranges, url, fd, progress, server, receiver)
+        except Exception as e:
+            # Whatever arrived may still be fine, the blocks that don't verify are retried
+            print(f"    Download of {len(request_ranges)} ranges failed: {e}")
+        return receiver.finish()
+
+    @staticmethod
+    def _working_paths(target_path):
+        # Next to the file the result replaces, so the final rename is atomic: copying over a running
+        # AppImage in place could leave it half written
+        target_path = os.path.abspath(target_path)
+        directory = os.path.dirname(target_path)
+        name = os.path.basename(target_path)
+        if not os.access(directory, os.W_OK):
+            raise Exception(f"Can't update '{target_path}', '{directory}' is not writable")
+        return os.path.join(directory, f".{name}.msync-part"), os.path.join(directory, f".{name}.msync-journal")
+
+    def _prepare_fixed(self, file_path, tmp_path):
+        print("Checking blocks to patch")
+        blocks = MSync.get_file_blocks(file_path, self.block_hash)
+        changed_blocks = []
+        for i in range(len(self.blocks)):
+            if i >= len(blocks) or blocks[i] != self.blocks[i]:
+                changed_blocks.append(i)
+
+        if changed_blocks and self.weak_blocks is not None:
+            changed_blocks = self._reuse_moved_blocks(file_path, tmp_path, blocks, changed_blocks)
+
+        return changed_blocks
+
+    def _reuse_moved_blocks(self, file_path, tmp_path, local_blocks, changed_blocks):
+        print("Looking for moved blocks in local file")
+        block_size = MSync.block_size
+        size = MSync.get_file_size(file_path)
+        if size < block_size:
+            return changed_blocks
+
+        wanted = {}
+        for i in changed_blocks:
+            if min(block_size, self.size - i * block_size) == block_size:
+                wanted.setdefault(self.weak_blocks[i], []).append(i)
+
+        # Only windows overlapping local blocks that are not already in place can hold moved data
+        spans = []
+        for j in range(len(local_blocks)):
+            if j < len(self.blocks) and local_blocks[j] == self.blocks[j]:
+                continue
+            start = max(0, j * block_size - block_size + 1)
+            end = min((j + 1) * block_size, size - block_size + 1)
+            if spans and spans[-1][1] >= start:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+
+        found = {}
+        budget = MSync.max_scan_miss
+        deadline = time.monotonic() + sum(len(indices) for indices in wanted.values()) * block_size / MSync.scan_bandwidth
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in spans:
+                if not wanted:
+                    break
+                budget = self._scan_weak(data, start, end, wanted, found, budget, deadline)
+                if budget <= 0:
+                    print("    Scan budget exhausted, downloading the remaining blocks")
+                    break
+
+            with open(tmp_path, 'rb+') as dst:
+                for i, offset in found.items():
+                    MSync.copy_range(f.fileno(), dst.fileno(), offset, i * block_size, block_size)
+
+        print(f"    Reused {len(found)} moved blocks")
+        return [i for i in changed_blocks if i not in found]
+
+    def _scan_weak(self, data, start, end, wanted, found, budget, deadline):
+        # rsync-style rolling Adler-32 over every window starting in [start, end), returns the
+        # budget left (bytes that may still be scanned without a match)
+        block_size = MSync.block_size
+        a, b = MSync._weak_sums(data[start:start + block_size])
+        p = start
+        limit = p + budget
+        check = p + MSync._scan_check_interval
+        while p < end:
+            if p >= check:
+                if p >= limit or time.monotonic() > deadline:
+                    return 0
+                check = p + MSync._scan_check_interval
+            indices = wanted.get(a | (b << 16))
+            if indices is not None:
+                block_hash = MSync.calculate_block_hash(data[p:p + block_size], self.block_hash)
+                matched = [i for i in indices if self.blocks[i] == block_hash]
+                if matched:
+                    for i in matched:
+                        found[i] = p
+                    indices = [i for i in indices if i not in found]
+                    if indices:
+                        wanted[a | (b << 16)] = indices
+                    else:
+                        del wanted[a | (b << 16)]
+                    if not wanted:
+                        break
+
+                    p += block_size
+                    limit = p + MSync.max_scan_miss
+                    if p >= end:
+                        break
+                    a, b = MSync._weak_sums(data[p:p + block_size])
+                    continue
+
+            if p + 1 >= end:
+                break
+            out_byte = data[p]
+            a = (a - out_byte + data[p + block_size]) % 65521
+            b = (b - block_size * out_byte + a - 1) % 65521
+            p += 1
+        return limit - p
+
+    def _reuse_seed_blocks(self, seeds, tmp_path, changed_blocks):
+        # Blocks are matched by content, so any seed holding one at any offset can provide it
+        wanted = {}
+        for i in changed_blocks:
+            wanted.setdefault(self.blocks[i], []).append(i)
+
+        found = set()
+        chunking = "fixed" if self.chunks is None else "cdc"
+        with open(tmp_path, 'rb+') as dst:
+            for seed in seeds:
+                if not wanted:
+                    break
+                print(f"Indexing blocks of '{seed}'")
+                _, seed_blocks = MSync._scan_blocks(seed, chunking, self.block_hash)
+                reused = 0
+                with open(seed, 'rb') as src:
+                    for offset, length, block, _ in seed_blocks:
+                        for i in wanted.get(block, []):
+                            start, end = self._block_range(i)
+                            if end - start == length:
+                                MSync.copy_range(src.fileno(), dst.fileno(), offset, start, length)
+                                found.add(i)
+                                reused += 1
+                        if block in wanted:
+                            wanted[block] = [i for i in wanted[block] if i not in found]
+                            if not wanted[block]:
+                                del wanted[block]
+                print(f"    Reused {reused} blocks")
+
+        return [i for i in changed_blocks if i not in found]
+
+    @staticmethod
+    def find_seeds(paths, exclude = [], app_name = None):
+        # Seeds are files or directories holding other AppImages (siblings, older or cached versions).
+        # With app_name only the AppImages in the directories named after the app are used
+        excluded = {os.path.realpath(path) for path in exclude}
+        prefix = re.sub(r"[^a-z0-9]", "", app_name.lower()) if app_name else ""
+        seeds = []
+        for path in paths:
+            path = os.path.expanduser(path)
+            if os.path.isdir(path):
+                candidates = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                              if name.lower().endswith(".appimage") and not name.startswith(".")
+                              and re.sub(r"[^a-z0-9]", "", name.lower()).startswith(prefix)]
+            else:
+                candidates = [path]
+            for candidate in candidates:
+                real_path = os.path.realpath(candidate)
+                if os.path.isfile(real_path) and real_path not in excluded and os.access(real_path, os.R_OK):
+                    excluded.add(real_path)
+                    seeds.append(candidate)
+        return seeds
+
     @staticmethod
     def from_url(url:str):
-        response = requests.get(url, stream=True)
+        response = requests.get(url)
         response.raise_for_status()
-        data = response.json()
 
-        return MSync(data["name"], data["size"], data["hash"], data["blocks"], url)
+        return MSync.from_bytes(response.content, url)
 
     @staticmethod
     def from_file(file_path:str):
-        data={}
-        with open(file_path, "r") as archivo:
-            data = json.load(archivo)  # Convierte el JSON a un diccionario de Python
+        with open(file_path, "rb") as archivo:
+            return MSync.from_bytes(archivo.read())
+
+    @staticmethod
+    def from_bytes(content, url = None):
+        if not content.startswith(MSync.binary_magic):
+            return MSync._from_data(json.loads(content), url)  # Manifiesto JSON antiguo
+
+        _, version, flags, _ = MSync._binary_header.unpack_from(content)
+        if version != MSync.binary_version:
+            raise Exception(f"Unsupported binary MSync version {version}")
+
+        body = memoryview(content)[MSync._binary_header.size:]
+        if flags & MSync.FLAG_COMPRESSED:
+            body = memoryview(zlib.decompress(body))
+
+        size, count, block_size, digest_size, hash_size, name_len = MSync._binary_body.unpack_from(body)
+        if block_size != MSync.block_size:
+            raise Exception(f"Unsupported MSync block size {block_size}")
+
+        position = MSync._binary_body.size
+        name = bytes(body[position:position + name_len]).decode()
+        position += name_len
+        algorithms = [MSync.default_block_hash, MSync.default_file_hash]
+        if flags & MSync.FLAG_ALGORITHMS:
+            for n in range(2):
+                algorithms[n] = bytes(body[position + 1:position + 1 + body[position]]).decode()
+                position += 1 + body[position]
+        hash = body[position:position + hash_size].hex()
+        position += hash_size
+        blocks = BlockDigests(body[position:position + count * digest_size], digest_size)
+        position += count * digest_size
+
+        weak_blocks = None
+        if flags & MSync.FLAG_WEAK:
+            weak_blocks = MSync._unpack_uint32(body[position:position + count * 4])
+            position += count * 4
+
+        chunks = None
+        if flags & MSync.FLAG_CHUNKS:
+            chunks = ChunkTable(MSync._unpack_uint32(body[position:position + count * 4]))
+
+        return MSync(name, size, hash, blocks, url, chunks, weak_blocks, *algorithms)
+
+    @staticmethod
+    def _pack_uint32(values):
+        packed = array.array("I", values)
+        if sys.byteorder != "little":
+            packed.byteswap()
+        return packed.tobytes()
+
+    @staticmethod
+    def _unpack_uint32(view):
+        if sys.byteorder == "little":
+            return view.cast("I")
+        values = array.array("I", view)
+        values.byteswap()
+        return values
 
-        return MSync(data["name"], data["size"], data["hash"], data["blocks"])
+    @staticmethod
+    def _from_data(data, url = None):
+        block_hash = data.get("block_hash", MSync.default_block_hash)
+        file_hash = data.get("file_hash", MSync.default_file_hash)
+        if data.get("version", 1) == 1:
+            return MSync(data["name"], data["size"], data["hash"], data["blocks"], url, None, data.get("weak"), block_hash, file_hash)
+        if data["version"] == 2:
+            chunks = [(offset, length) for offset, length, _ in data["chunks"]]
+            blocks = [block for _, _, block in data["chunks"]]
+            return MSync(data["name"], data["size"], data["hash"], blocks, url, chunks, None, block_hash, file_hash)
+        raise Exception(f"Unsupported MSync version {data['version']}")
 
     @staticmethod
-    def from_binary(file_path:str):
+    def from_binary(file_path:str, chunking = "fixed", block_hash = default_block_hash, file_hash = default_file_hash):
+        if chunking not in ("fixed", "cdc"):
+            raise ValueError(f"Unknown chunking mode '{chunking}'")
+        for algorithm in [block_hash, file_hash]:
+            if algorithm not in MSync.hash_algorithms:
+                raise ValueError(f"Unknown hash algorithm '{algorithm}'")
+
         name = os.path.basename(file_path)
         size = MSync.get_file_size(file_path)
-        hash = MSync.calculate_file_hash(file_path)
-        blocks = MSync.get_file_blocks(file_path)
-        
-        return MSync(name, size, hash, blocks)
+        with metrics.phase("msync.from_binary", size):
+            hash, file_blocks = MSync._scan_blocks(file_path, chunking, block_hash, weak = chunking == "fixed", file_hash = file_hash)
+        blocks = [block for _, _, block, _ in file_blocks]
+
+        if chunking == "fixed":
+            weak_blocks = [weak for _, _, _, weak in file_blocks]
+            return MSync(name, size, hash, blocks, None, None, weak_blocks, block_hash, file_hash)
 
+        chunks = [(offset, length) for offset, length, _, _ in file_blocks]
+        return MSync(name, size, hash, blocks, None, chunks, None, block_hash, file_hash)
 
     @staticmethod
-    def get_file_blocks(file_path):
-        blocks = []
-        futures = []
+    def get_file_blocks(file_path, algorithm = default_block_hash):
+        _, file_blocks = MSync._scan_blocks(file_path, "fixed", algorithm)
+        return [block for _, _, block, _ in file_blocks]
 
-        with open(file_path, 'rb') as f, ThreadPoolExecutor() as executor:
-            while True:
-                block = f.read(MSync.block_size)
-                if not block:
-                    break
-                
-                futures.append(executor.submit(MSync.calculate_block_hash, block))
+    @staticmethod
+    def get_file_chunks(file_path, algorithm = default_block_hash):
+        _, file_blocks = MSync._scan_blocks(file_path, "cdc", algorithm)
+        return [(offset, length, block) for offset, length, block, _ in file_blocks]
 
-            for future in futures:
-                blocks.append(future.result())
+    @staticmethod
+    def _scan_blocks(file_path, chunking = "fixed", block_hash = default_block_hash, weak = False, file_hash = None, digest = None):
+        # Single mmap-backed pass: the file hash is updated sequentially while block hashes are
+        # computed by a pool (hashlib releases the GIL) with at most max_in_flight blocks pending.
+        # An external digest object, if given, is fed the file contents too
+        file_digest = MSync.hash_algorithms[file_hash]() if file_hash else None
+        results = []
+        size = MSync.get_file_size(file_path)
+        if size == 0:
+            return file_digest.hexdigest() if file_hash else None, results
 
-        return blocks
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            pending = deque()
+            released = 0
+
+            def collect():
+                nonlocal released
+                offset, length, block, future = pending.popleft()
+                block_hash, block_weak = future.result()
+                block.release()
+                results.append((offset, length, block_hash, block_weak))
+                # Drop pages already hashed so resident memory doesn't grow with the file
+                done = (offset + length) // mmap.PAGESIZE * mmap.PAGESIZE
+                if hasattr(data, "madvise") and done > released:
+                    data.madvise(mmap.MADV_DONTNEED, released, done - released)
+                    released = done
+
+            try:
+                with ThreadPoolExecutor() as executor:
+                    for offset, length in MSync._iter_blocks(data, size, chunking):
+                        block = view[offset:offset + length]
+                        if file_digest is not None:
+                            file_digest.update(block)
+                        if digest is not None:
+                            digest.update(block)
+                        pending.append((offset, length, block, executor.submit(MSync._hash_block, block, block_hash, weak)))
+                        if len(pending) >= MSync.max_in_flight:
+                            collect()
+
+                    while pending:
+                        collect()
+            finally:
+                for _, _, block, _ in pending:
+                    block.release()
+                view.release()
+
+        return file_digest.hexdigest() if file_hash else None, results
+
+    @staticmethod
+    def _iter_blocks(data, size, chunking):
+        offset = 0
+        while offset < size:
+            if chunking == "cdc":
+                end = MSync._find_chunk_end(data, offset, size)
+            else:
+                end = min(offset + MSync.block_size, size)
+            yield offset, end - offset
+            offset = end
+
+    @staticmethod
+    def _hash_block(block, algorithm, weak):
+        return MSync.calculate_block_hash(block, algorithm), MSync.calculate_weak_hash(block) if weak else None
+
+    @staticmethod
+    def _find_chunk_end(data, offset, size):
+        start = offset + MSync.cdc_min_size
+        end = min(offset + MSync.cdc_max_size, size)
+        if start >= end:
+            return end
+
+        normal = min(offset + MSync.cdc_avg_size, end)
+        window = MSync._cdc_window
+        position = data.find(MSync._cdc_anchor, start, end)
+        while position != -1:
+            mask = MSync._cdc_mask_small if position < normal else MSync._cdc_mask_large
+            if not zlib.crc32(data[position - window:position + 1]) & mask:
+                return position + 1
+            position = data.find(MSync._cdc_anchor, position + 1, end)
+        return end
              
+    @staticmethod
+    def clone_file(src_path, dst_path):
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            try:
+                # FICLONE: share extents on reflink-capable filesystems (btrfs, xfs, bcachefs...)
+                fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+                return
+            except OSError:
+                pass
+            MSync.copy_range(src.fileno(), dst.fileno(), 0, 0, os.fstat(src.fileno()).st_size)
+
+    @staticmethod
+    def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+        try:
+            # copy_file_range lets the kernel clone or copy without passing through userspace
+            while length > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+                if copied == 0:
+                    break
+                src_offset += copied
+                dst_offset += copied
+                length -= copied
+        except (AttributeError, OSError):
+            pass
+
+        while length > 0:
+            data = os.pread(src_fd, min(length, MSync.block_size), src_offset)
+            if not data:
+                break
+            os.pwrite(dst_fd, data, dst_offset)
+            src_offset += len(data)
+            dst_offset += len(data)
+            length -= len(data)
+
     @staticmethod   
     def get_file_size(file_path):
         return os.stat(file_path).st_size
                 
     @staticmethod
-    def calculate_block_hash(block):
-        md5_hash = hashlib.md5()
-        md5_hash.update(block)
-        return md5_hash.hexdigest()
+    def calculate_block_hash(block, algorithm = default_block_hash):
+        block_hash = MSync.hash_algorithms[algorithm]()
+        block_hash.update(block)
+        return block_hash.hexdigest()
     
     @staticmethod
-    def calculate_file_hash(file_path):
-        sha256_hash = hashlib.sha256()
+    def calculate_weak_hash(block):
+        return zlib.adler32(block)
+
+    @staticmethod
+    def _weak_sums(block):
+        # Adler-32 halves, rolled byte by byte in _scan_weak
+        weak = zlib.adler32(block)
+        return weak & 0xFFFF, weak >> 16
+
+    @staticmethod
+    def calculate_file_hash(file_path, algorithm = default_file_hash):
+        return MSync.file_digest(file_path, algorithm).hexdigest()
+
+    @staticmethod
+    def file_digest(file_path, algorithm = default_file_hash):
         with open(file_path, 'rb') as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, MSync.hash_algorithms[algorithm])
+            file_hash = MSync.hash_algorithms[algorithm]()
+            buffer = bytearray(MSync.file_buffer_size)
+            view = memoryview(buffer)
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                file_hash.update(view[:read])
+            return file_hash
 
     @staticmethod
-    def download_chunk(session, start, end, url):
+    def download_chunk(session, start, end, url, fd, progress = None, receiver = None):
         headers = {'Range': f'bytes={start}-{end - 1}'}  # Ajuste: rango es inclusivo
-        response = session.get(url, headers=headers, stream=True)
+        with session.get(url, headers=headers, stream=True) as response:
+            if response.status_code not in [200, 206]:
+                raise Exception(f"Error en la descarga: {response.status_code}")
+
+            # A 200 means the server ignored the range and sends the whole file
+            position = start if response.status_code == 206 else 0
+            for piece in response.iter_content(chunk_size=MSync.stream_chunk_size):
+                piece_end = position + len(piece)
+                if piece_end > start:
+                    piece = piece[max(0, start - position):min(len(piece), end - position)]
+                    os.pwrite(fd, piece, max(position, start))
+                    if progress is not None:
+                        progress.update(len(piece))
+                    if receiver is not None:
+                        receiver.update(piece, max(position, start))
+                position = piece_end
+                if position >= end:
+                    break
+
+        if position < end:
+            raise Exception(f"Incomplete download for range {start}-{end - 1}")
+
+    @staticmethod
+    def download_ranges(session, ranges, url, fd, progress = None, server = None, receiver = None):
+        # receiver (if any) gets every piece once it's written, in stream order
+        if len(ranges) == 1 or (server is not None and not server["multi_range"]):
+            for start, end in ranges:
+                MSync.download_chunk(session, start, end, url, fd, progress, receiver)
+            return
+
+        # Body is parsed straight from the socket, so ask for it uncompressed
+        headers = {'Range': 'bytes=' + ','.join(f'{start}-{end - 1}' for start, end in ranges), 'Accept-Encoding': 'identity'}
+        written = []
+        with session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 200:
+                # Server ignores multi-range requests, stop here and use one request per range from now on
+                if server is not None:
+                    server["multi_range"] = False
+            elif response.status_code != 206:
+                raise Exception(f"Error en la descarga: {response.status_code}")
+            else:
+                reader = io.BufferedReader(response.raw, MSync.stream_chunk_size)
+                content_type = response.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/byteranges"):
+                    boundary = content_type.split("boundary=")[1].split(";")[0].strip().strip('"')
+                    written = MSync._read_multipart(reader, boundary, fd, progress, receiver)
+                else:
+                    # Server merged the ranges into a single one
+                    start, end = MSync._parse_content_range(response.headers["Content-Range"])
+                    MSync._write_stream(reader, start, end, fd, progress, receiver)
+                    written = [(start, end)]
+
+        covered = MSync._group_ranges(written)
+        for start, end in ranges:
+            if not any(c_start <= start and end <= c_end for c_start, c_end in covered):
+                MSync.download_chunk(session, start, end, url, fd, progress, receiver)
+
+    @staticmethod
+    def _read_multipart(reader, boundary, fd, progress, receiver = None):
+        delimiter = f"--{boundary}".encode()
+        written = []
+        line = reader.readline()
+        while line and not line.startswith(delimiter):
+            line = reader.readline()
+
+        while line and not line.rstrip().endswith(b"--"):
+            content_range = None
+            line = reader.readline()
+            while line and line.strip():
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-range":
+                    content_range = value.strip()
+                line = reader.readline()
+
+            if content_range is None:
+                raise Exception("Missing Content-Range in multipart response")
+            start, end = MSync._parse_content_range(content_range)
+            MSync._write_stream(reader, start, end, fd, progress, receiver)
+            written.append((start, end))
 
-        if response.status_code not in [200, 206]:
-            raise Exception(f"Error en la descarga: {response.status_code}")
+            line = reader.readline()
+            while line and not line.startswith(delimiter):
+                line = reader.readline()
 
-        chunk = b"".join(response.iter_content(chunk_size=MSync.block_size))
-        return chunk, start, end
+        return written
 
     @staticmethod
-    def _group_blocks(file_size, changed_blocks):
+    def _write_stream(reader, start, end, fd, progress, receiver = None):
+        position = start
+        while position < end:
+            piece = reader.read(min(MSync.stream_chunk_size, end - position))
+            if not piece:
+                raise Exception(f"Incomplete download for range {start}-{end - 1}")
+            os.pwrite(fd, piece, position)
+            if receiver is not None:
+                receiver.update(piece, position)
+            position += len(piece)
+            if progress is not None:
+                progress.update(len(piece))
+
+    @staticmethod
+    def _parse_content_range(content_range):
+        # bytes <first>-<last>/<total>
+        first, last = content_range.split()[1].split("/")[0].split("-")
+        return int(first), int(last) + 1
+
+    @staticmethod
+    def _group_ranges(ranges, max_gap = 0, max_size = None):
+        # With max_size, ranges aren't grown past it (block ranges then split at block boundaries)
         grouped = []
-        start_index = changed_blocks[0]  
-        
-        for i in range(1, len(changed_blocks)):
-            if changed_blocks[i] != changed_blocks[i - 1] + 1:
-                end_index = changed_blocks[i - 1]
-                grouped.append((start_index, end_index))
-                start_index = changed_blocks[i]
-        
-        # Agrega el último rango
-        grouped.append((start_index, changed_blocks[-1]))
-        
-        ranges = [(start * MSync.block_size, min((end + 1) * MSync.block_size, file_size)) for start, end in grouped]
-        return ranges
+        for start, end in sorted(ranges):
+            if grouped and start - grouped[-1][1] <= max_gap \
+                    and (max_size is None or max(grouped[-1][1], end) - grouped[-1][0] <= max_size):
+                grouped[-1] = (grouped[-1][0], max(grouped[-1][1], end))
+            else:
+                grouped.append((start, end))
+        return grouped
+
+    @staticmethod
+    def _plan_requests(ranges, max_gap = 0):
+        # Gaps cheaper to download than a separate range are merged, then ranges are packed into multi-range requests
+        # No request gets over max_request_size, so a fully changed file is still fetched in parallel pieces
+        planned = []
+        for start, end in MSync._group_ranges(ranges, max_gap, MSync.max_request_size):
+            if planned and len(planned[-1]) < MSync.max_ranges_per_request \
+                    and sum(e - s for s, e in planned[-1]) + (end - start) <= MSync.max_request_size:
+                planned[-1].append((start, end))
+            else:
+                planned.append([(start, end)])
+        return planned
     
     @staticmethod
     def format_bytes(size: int) -> str:        
@@ -211,3 +877,241 @@ class MSync:
             size /= factor
 
         return f"{size:.2f} YB"
+
+
+class DownloadProgress:
+    def __init__(self, total) -> None:
+        self.total = total
+        self.done = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+
+    def add_total(self, size):
+        with self.lock:
+            self.total += size
+
+    def update(self, size):
+        with self.lock:
+            self.done += size
+            percent = math.floor(100 * self.done / self.total) if self.total else 100
+            if percent >= self.reported + 10 or self.done == self.total:
+                self.reported = percent
+                print(f"    Downloaded {MSync.format_bytes(self.done)}/{MSync.format_bytes(self.total)} ({percent}%)")
+
+
+class PatchVerifier:
+    # Checks blocks as their requests finish and feeds the file hash in block order meanwhile,
+    # so the end of the patch doesn't read the whole file again
+    def __init__(self, msync, fd, ready) -> None:
+        self.msync = msync
+        self.fd = fd
+        self.digest = MSync.hash_algorithms[msync.file_hash]()
+        # Blocks known to be right: placed from local data (already matched by hash) or verified
+        self.ready = set(ready)
+        self.next = 0
+        self.advancing = False
+        self.lock = threading.Lock()
+
+    def verify_block(self, i, data):
+        # data is the whole block, it feeds the file hash right away when the block is next in order
+        if MSync.calculate_block_hash(data, self.msync.block_hash) != self.msync.blocks[i]:
+            return False
+        self.add([i], {i: data})
+        return True
+
+    def add(self, blocks, contents = None):
+        # contents maps blocks to the data already read for them, the rest are read again when their turn comes
+        with self.lock:
+            self.ready.update(blocks)
+            # A single thread moves the hash forward, the others only mark their blocks
+            if self.advancing:
+                return
+            self.advancing = True
+        try:
+            while True:
+                with self.lock:
+                    if self.next not in self.ready:
+                        self.advancing = False
+                        return
+                    i = self.next
+                data = contents.get(i) if contents else None
+                if data is None:
+                    start, end = self.msync._block_range(i)
+                    data = os.pread(self.fd, end - start, start)
+                self.digest.update(data)
+                with self.lock:
+                    self.next += 1
+        except BaseException:
+            with self.lock:
+                self.advancing = False
+            raise
+
+    def finish(self):
+        self.add([])
+        if self.next < len(self.msync.blocks):
+            raise Exception(f"Block {self.next} was never verified")
+        return self.digest.hexdigest()
+
+
+class BlockReceiver:
+    # Checks the blocks of a request while its data is written: only the block being received is
+    # kept in memory, and it's hashed and journaled as soon as it's complete
+    def __init__(self, msync, fd, blocks, verifier, journal) -> None:
+        self.msync = msync
+        self.fd = fd
+        self.blocks = set(blocks)
+        self.verifier = verifier
+        self.journal = journal
+        self.checked = set()
+        self.failed = []
+        self.block = None
+        self.buffer = None
+        self.start = 0
+        self.filled = 0
+
+    def update(self, piece, position):
+        view = memoryview(piece)
+        while view:
+            if self.block is None or position != self.start + self.filled:
+                # Data not continuing the current block, the ones left incomplete are read back in finish()
+                i = self.msync._block_index(position)
+                start, end = self.msync._block_range(i)
+                if start != position or i not in self.blocks or i in self.checked:
+                    self.block = None
+                    skip = min(len(view), end - position)
+                    view = view[skip:]
+                    position += skip
+                    continue
+                self.block, self.start, self.filled = i, start, 0
+                self.buffer = bytearray(end - start)
+
+            take = min(len(view), len(self.buffer) - self.filled)
+            self.buffer[self.filled:self.filled + take] = view[:take]
+            self.filled += take
+            view = view[take:]
+            position += take
+            if self.filled == len(self.buffer):
+                self._check(self.block, self.buffer)
+                self.block = None
+                self.buffer = None
+
+    def finish(self):
+        # Returns the blocks that have to be downloaded again
+        self.buffer = None
+        for i in sorted(self.blocks - self.checked):
+            start, end = self.msync._block_range(i)
+            self._check(i, os.pread(self.fd, end - start, start))
+        return self.failed
+
+    def _check(self, i, data):
+        self.checked.add(i)
+        if self.verifier.verify_block(i, data):
+            self.journal.add(self.fd, [i])
+        else:
+            self.failed.append(i)
+
+
+class PatchJournal:
+    def __init__(self, path, hash, size, chunking = "fixed", blocks = None) -> None:
+        self.path = path
+        # Block numbers only mean something for the same target split the same way
+        self.header = json.dumps({"hash": hash, "size": size, "chunking": chunking, "blocks": blocks})
+        self.lock = threading.Lock()
+        self.file = None
+
+    def open(self):
+        # Returns the blocks verified by a previous run towards the same target
+        self.file = open(self.path, "a+")
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            raise Exception(f"Another update is already using '{self.path}'")
+
+        self.file.seek(0)
+        # Anything after the last newline is a partial write from an interrupted run
+        lines = self.file.read().split("\n")[:-1]
+        if not lines or lines[0] != self.header:
+            self.reset()
+            return set()
+
+        blocks = set()
+        for line in lines[1:]:
+            blocks.update(int(block) for block in line.split())
+        return blocks
+
+    def reset(self):
+        with self.lock:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(self.header + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def add(self, fd, blocks):
+        if not blocks:
+            return
+        with self.lock:
+            # Block data must be on disk before the journal claims it
+            os.fsync(fd)
+            self.file.write(" ".join(str(block) for block in blocks) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self, remove = False):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if remove:
+            os.remove(self.path)
+
+
+class BlockDigests:
+    # Hex view over packed raw digests, each one is only decoded when accessed
+    def __init__(self, view, digest_size) -> None:
+        self.view = view
+        self.digest_size = digest_size
+
+    def __len__(self):
+        return len(self.view) // self.digest_size if self.digest_size else 0
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.view[i * self.digest_size:(i + 1) * self.digest_size].hex()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ChunkTable:
+    # (offset, length) of every chunk, offsets are derived from the packed lengths on first use
+    def __init__(self, lengths) -> None:
+        self.lengths = lengths
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return self._get_offsets()[i], self.lengths[i]
+
+    def find(self, offset):
+        # Index of the chunk holding offset
+        return bisect.bisect_right(self._get_offsets(), offset) - 1
+
+    def _get_offsets(self):
+        if self.offsets is None:
+            self.offsets = [0]
+            for length in self.lengths[:-1]:
+                self.offsets.append(self.offsets[-1] + length)
+        return self.offsets
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,30 @@
+import unittest
+
+from py_modules.msync import MSync
+
+class TestPlanRequests(unittest.TestCase):
+    def fixed_manifest(self, blocks):
+        return MSync("app.AppImage", blocks * MSync.block_size, "0" * 64, ["0" * 32] * blocks)
+
+    def test_gap_of_one_fixed_block_is_merged(self):
+        msync = self.fixed_manifest(5)
+        ranges = [msync._block_range(1), msync._block_range(3)]
+        plan = MSync._plan_requests(ranges, msync._request_cost())
+        self.assertEqual(plan, [[(MSync.block_size, 4 * MSync.block_size)]])
+
+    def test_larger_gaps_stay_separate_ranges(self):
+        msync = self.fixed_manifest(6)
+        ranges = [msync._block_range(1), msync._block_range(4)]
+        plan = MSync._plan_requests(ranges, msync._request_cost())
+        self.assertEqual(plan, [[(MSync.block_size, 2 * MSync.block_size), (4 * MSync.block_size, 5 * MSync.block_size)]])
+
+    def test_requests_are_split_at_max_request_size(self):
+        blocks = 3 * MSync.max_request_size // MSync.block_size
+        msync = self.fixed_manifest(blocks)
+        plan = MSync._plan_requests([msync._block_range(i) for i in range(blocks)], msync._request_cost())
+        self.assertEqual(len(plan), 3)
+        for request_ranges in plan:
+            self.assertEqual(sum(end - start for start, end in request_ranges), MSync.max_request_size)
+
+if __name__ == "__main__":
+    unittest.main()